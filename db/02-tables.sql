@@ -123,6 +123,18 @@ CREATE TABLE survey.product (
 WITH (autovacuum_enabled='on');
 ALTER TABLE survey.product ADD FOREIGN KEY ("detection_id") REFERENCES survey.detection ("id") ON DELETE CASCADE;
 ALTER TABLE survey.product ADD CONSTRAINT product_detection_id_key UNIQUE (detection_id);
+-- Products are stored uncompressed so chunks can be read with substring without detoasting the whole value
+ALTER TABLE survey.product
+    ALTER COLUMN cube SET STORAGE EXTERNAL,
+    ALTER COLUMN mask SET STORAGE EXTERNAL,
+    ALTER COLUMN mom0 SET STORAGE EXTERNAL,
+    ALTER COLUMN mom1 SET STORAGE EXTERNAL,
+    ALTER COLUMN mom2 SET STORAGE EXTERNAL,
+    ALTER COLUMN chan SET STORAGE EXTERNAL,
+    ALTER COLUMN snr SET STORAGE EXTERNAL,
+    ALTER COLUMN spec SET STORAGE EXTERNAL,
+    ALTER COLUMN pv SET STORAGE EXTERNAL,
+    ALTER COLUMN plot SET STORAGE EXTERNAL;
 ALTER TABLE survey.product OWNER TO admin;
 
 ------------------------------------------------------------------------------
@@ -286,3 +298,69 @@ ALTER TABLE survey.task OWNER TO admin;
 -- Required extensions
 CREATE EXTENSION IF NOT EXISTS "postgis";
 CREATE EXTENSION IF NOT EXISTS "pg_sphere";
+
+------------------------------------------------------------------------------
+-- Spatial index (requires pg_sphere)
+
+ALTER TABLE survey.detection ADD COLUMN IF NOT EXISTS pos spoint GENERATED ALWAYS AS (spoint(radians(ra), radians("dec"))) STORED;
+CREATE INDEX IF NOT EXISTS detection_pos_idx ON survey.detection USING GIST (pos);
+
+CREATE TABLE IF NOT EXISTS survey.released_source (
+    detection_id bigint primary key NOT NULL,
+    run_id bigint NOT NULL,
+    source_name character varying NOT NULL,
+    ra double precision,
+    "dec" double precision,
+    freq double precision,
+    pos spoint GENERATED ALWAYS AS (spoint(radians(ra), radians("dec"))) STORED
+);
+ALTER TABLE survey.released_source ADD FOREIGN KEY ("detection_id") REFERENCES survey.detection ("id") ON DELETE CASCADE;
+ALTER TABLE survey.released_source ADD FOREIGN KEY ("run_id") REFERENCES survey.run ("id") ON DELETE CASCADE;
+CREATE INDEX IF NOT EXISTS released_source_pos_idx ON survey.released_source USING GIST (pos);
+CREATE INDEX IF NOT EXISTS released_source_source_name_idx ON survey.released_source (source_name);
+-- Index the sources already released, the application keeps it in sync afterwards
+INSERT INTO survey.released_source (detection_id, run_id, source_name, ra, "dec", freq)
+    SELECT id, run_id, source_name, ra, "dec", freq FROM survey.detection
+    WHERE accepted AND source_name IS NOT NULL
+    ON CONFLICT (detection_id) DO NOTHING;
+ALTER TABLE survey.released_source OWNER TO admin;
+
+CREATE TABLE IF NOT EXISTS survey.detection_neighbour (
+    id bigserial primary key NOT NULL,
+    detection_id bigint NOT NULL,
+    neighbour_id bigint NOT NULL,
+    neighbour_run_id bigint NOT NULL,
+    sep double precision NOT NULL,
+    d_freq double precision,
+    UNIQUE (detection_id, neighbour_id)
+);
+ALTER TABLE survey.detection_neighbour ADD FOREIGN KEY ("detection_id") REFERENCES survey.detection ("id") ON DELETE CASCADE;
+ALTER TABLE survey.detection_neighbour ADD FOREIGN KEY ("neighbour_id") REFERENCES survey.detection ("id") ON DELETE CASCADE;
+ALTER TABLE survey.detection_neighbour ADD FOREIGN KEY ("neighbour_run_id") REFERENCES survey.run ("id") ON DELETE CASCADE;
+CREATE INDEX IF NOT EXISTS detection_neighbour_neighbour_id_idx ON survey.detection_neighbour (neighbour_id);
+CREATE INDEX IF NOT EXISTS detection_neighbour_neighbour_run_id_idx ON survey.detection_neighbour (neighbour_run_id);
+ALTER TABLE survey.detection_neighbour OWNER TO admin;
+
+CREATE TABLE IF NOT EXISTS survey.detection_neighbour_run (
+    run_id bigint primary key NOT NULL,
+    radius double precision NOT NULL,
+    max_detection_id bigint NOT NULL DEFAULT 0,
+    created timestamp without time zone DEFAULT now()
+);
+ALTER TABLE survey.detection_neighbour_run ADD FOREIGN KEY ("run_id") REFERENCES survey.run ("id") ON DELETE CASCADE;
+ALTER TABLE survey.detection_neighbour_run OWNER TO admin;
+
+------------------------------------------------------------------------------
+-- Product store, blobs moved from survey.product to files
+
+CREATE TABLE IF NOT EXISTS survey.product_file (
+    id bigserial primary key NOT NULL,
+    product_id bigint NOT NULL,
+    name varchar NOT NULL,
+    checksum char(64) NOT NULL,
+    size bigint NOT NULL
+);
+ALTER TABLE survey.product_file ADD FOREIGN KEY ("product_id") REFERENCES survey.product ("id") ON DELETE CASCADE;
+ALTER TABLE survey.product_file ADD CONSTRAINT product_file_product_id_name_key UNIQUE (product_id, name);
+CREATE INDEX IF NOT EXISTS product_file_checksum_idx ON survey.product_file (checksum);
+ALTER TABLE survey.product_file OWNER TO admin;
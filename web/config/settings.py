@@ -4,7 +4,13 @@ from pathlib import Path
 
 # Initialise environment variables
 env = environ.Env(
-    KINEMATICS=(bool, True)
+    KINEMATICS=(bool, True),
+    CROSS_MATCH_PROCESSES=(int, 1),
+    NEIGHBOUR_RADIUS=(float, 180.0),
+    PRODUCT_STORE=(str, ''),
+    PRODUCT_STORE_URL=(str, '/protected/products/'),
+    ARCHIVE_CACHE=(str, ''),
+    ARCHIVE_CACHE_SIZE=(float, 50.0)
 )
 environ.Env.read_env()
 
@@ -34,6 +40,22 @@ SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 KINEMATICS = env('KINEMATICS')
 
+# Number of worker processes for external cross matching (1 = serial)
+CROSS_MATCH_PROCESSES = env('CROSS_MATCH_PROCESSES')
+
+# Outer radius (arcsec) of the precomputed detection neighbour table
+NEIGHBOUR_RADIUS = env('NEIGHBOUR_RADIUS')
+
+# Directory of the content addressed product store (disabled if empty) and the
+# internal nginx location it is served from
+PRODUCT_STORE = env('PRODUCT_STORE')
+PRODUCT_STORE_URL = env('PRODUCT_STORE_URL')
+
+# Directory of the cache of generated product archives (disabled if empty) and
+# its size limit in GiB
+ARCHIVE_CACHE = env('ARCHIVE_CACHE')
+ARCHIVE_CACHE_SIZE = env('ARCHIVE_CACHE_SIZE')
+
 # ---------------------------------------------------------------------------------------
 # Application definition
 
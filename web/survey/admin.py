@@ -1,6 +1,7 @@
-import math
 import time
+import uuid
 import logging
+import numpy as np
 from random import choice
 
 from django.contrib import admin, messages
@@ -16,11 +17,20 @@ from django.db.models import Q
 from survey.utils.base import ModelAdmin, ModelAdminInline
 from survey.utils.task import task
 from survey.utils.forms import _add_tag, _add_comment, _get_or_create_tag
-from survey.utils.components import get_survey_components, get_release_name
+from survey.utils.components import get_survey_component_index, invalidate_survey_component_index, get_release_name
+from survey.utils.match import match_pairs, match_groups, THRESH_SPAT
+from survey.utils.neighbours import run_pairs, build_neighbours
+from survey.utils.locks import curation_lock, lock_release_names
+from survey.utils.crossmatch import DetectionSet, external_match, parallel_external_match, write_report, write_sweep
+from survey.utils.released import update_released_sources, released_name_runs, release_name_collisions, \
+    check_released_sources
+from survey.utils.sweep import load_separation_cache
+from survey.utils.columns import read_columns
+from survey.utils.writeback import WriteBack
 from survey.decorators import action_form, add_tag_form, add_comment_form, require_confirmation
 from survey.models import Detection, UnresolvedDetection, AcceptedDetection, ExternalConflict, \
     Instance, Run, Comment, Tag, TagDetection, Observation, SurveyComponent, \
-    Task, ValueTaskReturn, SurveyComponentRun, Tile, SourceExtractionRegion
+    Task, ValueTaskReturn, FileTaskReturn, SurveyComponentRun, Tile, SourceExtractionRegion, ReleasedSource
 
 from .tasks import download_accepted_sources, download_summaries_for_run
 
@@ -29,23 +39,26 @@ logging.basicConfig(level=logging.INFO)
 
 def sanity_check(request, queryset):
     try:
-        detect_list = list(queryset)
-        for index, detect_outer in enumerate(detect_list):
-            for detect_inner in detect_list[index + 1:]:
-                logging.info(f'Detections: {detect_outer.id}, {detect_inner.id}')
-                if detect_outer.is_match(detect_inner):
-                    logging.info('Passed is_match test')
-                    sanity, msg = detect_outer.sanity_check(detect_inner)
-                    if sanity is False:
-                        logging.info('Sanity check has failed')
-                        messages.error(request, msg)
-                    else:
-                        logging.info('Passed sanity_check test')
-                        messages.info(request, "sanity passed")
-                else:
-                    # TODO(austin): could probably keep both of these sources if not match...
-                    msg = f"Detections {detect_inner.id}, {detect_outer.id} are not in the same spacial and spectral range"  # noqa
+        detect_list = list(queryset.select_related('run'))
+        if not detect_list:
+            return
+        sanity_thresholds = detect_list[0].run.sanity_thresholds
+        ids, matrix = Detection.match_matrix(detect_list, sanity_thresholds=sanity_thresholds)
+        pairs = list(zip(*np.triu_indices(len(detect_list), 1)))
+        verdicts = iter(Detection.sanity_check_pairs(
+            detect_list, [(i, j) for i, j in pairs if matrix[i, j]], sanity_thresholds
+        ))
+        for i, j in pairs:
+            if matrix[i, j]:
+                _, _, sanity, msg = next(verdicts)
+                if sanity is False:
                     messages.error(request, msg)
+                else:
+                    messages.info(request, "sanity passed")
+            else:
+                # TODO(austin): could probably keep both of these sources if not match...
+                msg = f"Detections {ids[j]}, {ids[i]} are not in the same spacial and spectral range"  # noqa
+                messages.error(request, msg)
     except Exception as e:
         messages.error(request, str(e))
 
@@ -296,7 +309,7 @@ class DetectionAdmin(ModelAdmin):
         try:
             with transaction.atomic():
                 detect_list = list(queryset.select_for_update())
-                run_set = {detect.run.id for detect in detect_list}
+                run_set = {detect.run_id for detect in detect_list}
                 if len(run_set) > 1:
                     messages.error(
                         request,
@@ -493,7 +506,8 @@ class UnresolvedDetectionAdmin(ModelAdmin):
     @action_form(ResolveDetectionForm)
     def resolve_action(self, request, queryset, form):
         try:
-            with transaction.atomic():
+            runs = list(Run.objects.filter(id__in=queryset.values('run_id')))
+            with curation_lock(runs), transaction.atomic():
                 detect_list = list(queryset.select_for_update())
                 if len(detect_list) <= 1:
                     messages.error(
@@ -501,19 +515,22 @@ class UnresolvedDetectionAdmin(ModelAdmin):
                         "Can not resolve an empty or single detection"
                     )
                     return 0
-                run_set = {detect.run.id for detect in detect_list}
+                run_set = {detect.run_id for detect in detect_list}
                 if len(run_set) > 1:
                     messages.error(
                         request,
                         "Detections from multiple runs selected"
                     )
                     return 0
-                for index, detect_outer in enumerate(detect_list):
-                    for detect_inner in detect_list[index + 1:]:
-                        if not detect_outer.is_match(detect_inner):
-                            msg = f"Detections {detect_inner.id}, {detect_outer.id} are not in the same spacial and spectral range."  # noqa
-                            messages.error(request, msg)
-                            return 0
+                ids, matrix = Detection.match_matrix(
+                    detect_list, sanity_thresholds=detect_list[0].run.sanity_thresholds
+                )
+                not_matched = np.argwhere(np.triu(~matrix, 1))
+                if len(not_matched):
+                    i, j = not_matched[0]
+                    msg = f"Detections {ids[j]}, {ids[i]} are not in the same spacial and spectral range."  # noqa
+                    messages.error(request, msg)
+                    return 0
                 detect = choice(detect_list)
                 detect_list.remove(detect)
                 qs = queryset.filter(id__in=[detect.id for detect in detect_list])
@@ -531,12 +548,17 @@ class UnresolvedDetectionAdmin(ModelAdmin):
 
     @action_form(ChangeUnresolvedFlagDetectionForm)
     def manual_resolve(self, request, queryset, form):
-        with transaction.atomic():
-            detect_list = list(queryset.select_for_update())
-            for detect in detect_list:
-                detect.unresolved = False
-                detect.save(update_fields=["unresolved"])
-            return len(detect_list)
+        try:
+            runs = list(Run.objects.filter(id__in=queryset.values('run_id')))
+            with curation_lock(runs), transaction.atomic():
+                detect_list = list(queryset.select_for_update())
+                for detect in detect_list:
+                    detect.unresolved = False
+                    detect.save(update_fields=["unresolved"])
+                return len(detect_list)
+        except Exception as e:
+            messages.error(request, str(e))
+            return
 
     manual_resolve.short_description = "Manual Resolve Detections"
 
@@ -669,6 +691,7 @@ class AcceptedDetectionAdmin(ModelAdmin):
             for d in queryset:
                 d.accepted = False
                 d.save()
+            update_released_sources([d.id for d in queryset])
         return len(queryset)
     deselect.short_description = 'Deselect detection'
 
@@ -809,8 +832,9 @@ class RunAdmin(ModelAdmin):
     )
     ordering = ('-created',)
     search_fields = ['name']
-    actions = ['_download_summaries', '_internal_cross_match', '_external_cross_match',
-               '_release_sources', '_delete_run']
+    actions = ['_download_summaries', '_build_neighbours', '_internal_cross_match', '_auto_resolve',
+               '_external_cross_match', '_external_cross_match_preview', '_cross_match_sweep', '_release_sources',
+               '_delete_run']
 
     def has_delete_permission(self, request, obj=None):
         return False
@@ -850,24 +874,10 @@ class RunAdmin(ModelAdmin):
         return format_html(f"<a href='{url}'>External conflicts</a>")
     run_external_conflicts.short_description = 'External conflicts'
 
-    def _is_match(self, d1, d2, thresh_spat=90.0, thresh_spec=2e+6):
-        """Check if two detections are a match based on spatial and spectral separation.
-
-        """
-        try:
-            ra_i = d1.ra * math.pi / 180.0
-            dec_i = d1.dec * math.pi / 180.0
-            ra_j = d2.ra * math.pi / 180.0
-            dec_j = d2.dec * math.pi / 180.0
-            r_spat = 3600.0 * (180.0 / math.pi) * math.acos(math.sin(dec_i) * math.sin(dec_j) + math.cos(dec_i) * math.cos(dec_j) * math.cos(ra_i - ra_j))
-            r_spec = abs(d1.freq - d2.freq)
-        except Exception as e:
-            raise Exception(f"Math error {e}")
-        if r_spat < thresh_spat and r_spec < thresh_spec:
-            return True
-        return False
-
-    @task(exclusive_func_with=['internal_cross_match', 'external_cross_match', 'release_sources', 'delete_run', 'download_summaries'])
+    @task(exclusive_func_with=[
+        'internal_cross_match', 'auto_resolve', 'external_cross_match', 'release_sources', 'delete_run',
+        'download_summaries'
+    ])
     def download_summaries(self, request, queryset):
         try:
             return download_summaries_for_run(request, queryset)
@@ -887,11 +897,13 @@ class RunAdmin(ModelAdmin):
 
     _download_summaries.short_description = 'Download Summaries'
 
-    @task(exclusive_func_with=['internal_cross_match', 'external_cross_match', 'release_sources', 'delete_run', 'download_summaries'])
+    @task(exclusive_func_with=['download_summaries'])
     def delete_run(self, request, queryset):
         names = [i.name for i in queryset]
-        with transaction.atomic():
+        with curation_lock(list(queryset), survey_components=True), transaction.atomic():
             queryset._raw_delete(queryset.db)
+        # Raw delete does not send signals
+        invalidate_survey_component_index(Run)
         return ValueTaskReturn(f'Run(s) deleted: {names}')
 
     @require_confirmation
@@ -916,7 +928,28 @@ class RunAdmin(ModelAdmin):
         except Exception as e:
             messages.error(request, str(e))
 
-    @task(exclusive_func_with=['internal_cross_match', 'external_cross_match', 'release_sources', 'delete_run', 'download_summaries'])
+    @task()
+    def build_neighbours(self, request, queryset):
+        """Build the detection neighbour table for the selected runs.
+
+        """
+        runs = list(queryset.order_by('created', 'id'))
+        for run in runs:
+            with curation_lock([run]), transaction.atomic():
+                build_neighbours(run)
+        return ValueTaskReturn(f'Built detection neighbours for {",".join([r.name for r in runs])}')
+
+    def _build_neighbours(self, request, queryset):
+        try:
+            task_id = self.build_neighbours(request, queryset)
+            logging.info(f'Created task {task_id} for building detection neighbours')
+            return redirect('/admin/survey/task/')
+        except Exception as e:
+            messages.error(request, str(e))
+
+    _build_neighbours.short_description = 'Build detection neighbours'
+
+    @task()
     def internal_cross_match(self, request, queryset):
         """Run the internal cross matching workflow
 
@@ -926,9 +959,7 @@ class RunAdmin(ModelAdmin):
 
         run = queryset.first()
 
-        with transaction.atomic():
-            # This filter is here to lock all the detections
-            Detection.objects.filter(run=run).select_for_update()
+        with curation_lock([run]), transaction.atomic():
             all_run_detections = Detection.objects.filter(
                 run=run,
                 unresolved=False,
@@ -936,192 +967,243 @@ class RunAdmin(ModelAdmin):
                 rel__gte=0.7
             )
 
-            if any([d.unresolved for d in all_run_detections]):
+            if all_run_detections.filter(unresolved=True).exists():
                 raise Exception('There cannot be any unresolved detections for the run at the time of running internal cross matching.')
 
-            detections = list(Detection.objects.filter(run=run, accepted=True))
+            detections = DetectionSet.from_queryset(Detection.objects.filter(run=run, accepted=True))
+            if not len(detections):
+                return ValueTaskReturn(f'Completed internal cross matching for {run.name}')
 
             # cross match internally
+            ids, names = detections.ids, detections.names
+            start = time.time()
+            idx_i, idx_j = run_pairs(run, ids, detections.ra, detections.dec, detections.freq, accepted=True)
+            logging.info(
+                f'Internal cross matching of {len(ids)} detections completed in {round(time.time() - start, 2)} seconds'
+            )
+
             logging.info('The following pairs of detections have been marked as unresolved:')
-            matches = []
-            for i in range(len(detections) - 1):
-                for j in range(i + 1, len(detections) - 1):
-                    d1 = detections[i]
-                    d2 = detections[j]
-                    if self._is_match(d1, d2):
-                        matches.append((i, j))
-                        d1.unresolved = True
-                        d1.save()
-                        d2.unresolved = True
-                        d2.save()
-                        logging.info(f'{d1.name}, {d2.name}')
+            for i, j in zip(idx_i, idx_j):
+                logging.info(f'{names[i]}, {names[j]}')
+
+            matched_ids = np.union1d(ids[idx_i], ids[idx_j]).tolist()
+            Detection.objects.filter(id__in=matched_ids).update(unresolved=True)
 
             return ValueTaskReturn(f'Completed internal cross matching for {run.name}')
 
     _internal_cross_match.short_description = 'Internal cross matching'
 
-    @task(exclusive_func_with=['internal_cross_match', 'external_cross_match', 'release_sources', 'delete_run', 'download_summaries'])
-    def external_cross_match(self, request, queryset):
-        # Threshold values
-        thresh_spat = 90.0
-        thresh_spec = 2e+6
-        thresh_spat_auto = 5.0
-        thresh_spec_auto = 0.05e+6
-        SEARCH_THRESHOLD = 1.0
+    @task()
+    def auto_resolve(self, request, queryset):
+        """Resolve all unresolved detections of a run that are duplicates of
+        each other. Matching detections are grouped with a union-find, groups
+        where every pair matches keep the detection with the highest
+        reliability (then SNR, then lowest id) and the rest are deleted.
 
+        """
         if queryset.count() != 1:
-            raise Exception("Only one run can be selected at a time for external cross matching.")
+            raise Exception("Only one run can be selected at a time for auto resolving detections.")
 
-        # Check to make sure run is in survey_components
         run = queryset.first()
-        survey_component_runs = []
-        survey_components = get_survey_components()
-        for runs in survey_components.values():
-            survey_component_runs += runs
+        sigma = run.sanity_thresholds.get('uncertainty_sigma', 5)
+
+        with curation_lock([run]), transaction.atomic():
+            fields = ('id', 'ra', 'dec', 'freq', 'x', 'y', 'z', 'err_x', 'err_y', 'err_z', 'rel', 'f_sum', 'err_f_sum')
+            columns = read_columns(
+                Detection.objects.filter(run=run, unresolved=True).select_for_update(),
+                {f: 'i' if f == 'id' else 'f' for f in fields}
+            )
+            ids, ra, dec, freq, x, y, z, err_x, err_y, err_z, rel, f_sum, err_f_sum = (columns[f] for f in fields)
+            n = len(ids)
+            if n < 2:
+                return ValueTaskReturn(f'No unresolved detections to auto resolve for {run.name}')
 
-        if run.name not in survey_component_runs:
-            raise Exception("This run is not in the survey component list.")
+            start = time.time()
+            idx_i, idx_j = run_pairs(run, ids, ra, dec, freq, unresolved=True)
+            matched = match_pairs(x, y, z, err_x, err_y, err_z, idx_i, idx_j, sigma)
+            idx_i, idx_j = idx_i[matched], idx_j[matched]
+            labels = match_groups(n, idx_i, idx_j)
+
+            # Same rule as resolving by hand: all detections in a group must match each other
+            sizes = np.bincount(labels, minlength=n)
+            pairs = np.bincount(labels[idx_i], minlength=n)
+            complete = (sizes > 1) & (pairs == sizes * (sizes - 1) // 2)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                snr = np.nan_to_num(f_sum / err_f_sum, nan=-np.inf)
+            order = np.lexsort((ids, -snr, -np.nan_to_num(rel, nan=-np.inf)))
+            survivors = {}
+            for k in order:
+                if complete[labels[k]]:
+                    survivors.setdefault(labels[k], k)
+            resolve = np.array(sorted(survivors.values()), dtype=np.int64)
+            delete = np.nonzero(complete[labels])[0]
+            delete = np.setdiff1d(delete, resolve)
+            logging.info(f'Auto resolve of {n} detections completed in {round(time.time() - start, 2)} seconds')
+
+            for label, k in survivors.items():
+                group = ids[labels == label]
+                logging.info(f'Keeping detection {ids[k]} of duplicates {group.tolist()}')
+
+            Detection.objects.filter(id__in=ids[resolve].tolist()).update(unresolved=False)
+            Detection.objects.filter(id__in=ids[delete].tolist()).delete()
+
+        left = n - len(resolve) - len(delete)
+        return ValueTaskReturn(
+            f'Auto resolved {len(resolve)} groups in {run.name}, deleted {len(delete)} detections, '
+            f'{left} unresolved detections left to resolve manually'
+        )
+
+    def _auto_resolve(self, request, queryset):
+        try:
+            task_id = self.auto_resolve(request, queryset)
+            logging.info(f'Created task {task_id} for auto resolving detections')
+            return redirect('/admin/survey/task/')
+        except Exception as e:
+            messages.error(request, str(e))
+
+    _auto_resolve.short_description = 'Auto resolve unresolved detections'
+
+    def _get_run_components(self, runs):
+        """Check the runs and all other runs belong to a survey component and
+        return a mapping of run name to the survey components it belongs to.
+
+        """
+        # Membership must be current for curation, reload the cached index
+        index = get_survey_component_index(refresh=True)
+        run_components = index.run_components
+
+        for run in runs:
+            if run.name not in run_components:
+                raise Exception(f"Run {run.name} is not in the survey component list.")
 
         # Make sure all runs have a survey component
-        existing_runs = [r.name for r in Run.objects.all()]
-        if set(existing_runs) != set(survey_component_runs):
-            diff_runs = list(set(existing_runs) - set(survey_component_runs))
+        existing_runs = set(Run.objects.values_list('name', flat=True))
+        if existing_runs != set(run_components):
+            diff_runs = list(existing_runs - set(run_components))
             raise Exception(f"Runs with no survey components: {diff_runs}")
 
-        with transaction.atomic():
-            Detection.objects.filter(accepted=True, source_name__isnull=False).select_for_update()
+        return run_components
 
-            # Get survey components
-            survey_components = get_survey_components()
+    def _load_released_sources(self, runs):
+        """Load official released sources close to the accepted detections of
+        the runs from the released source index.
 
-            run_list = list(queryset)
-            if len(run_list) != 1:
-                raise Exception("Only one run can be selected at a time for external cross matching.")
+        """
+        check_released_sources()
+        return DetectionSet.from_queryset(
+            ReleasedSource.objects.filter(
+                source_name__contains=settings.PROJECT
+            ).near(Detection.objects.filter(run__in=runs, accepted=True), THRESH_SPAT),
+            fields=DetectionSet.RELEASED_FIELDS
+        )
+
+    def _external_match_run(self, run, run_components, released, timings):
+        """Compute the external cross matching decisions for a run against the
+        released sources of other runs, without writing to the database.
+        Phase timings are added to ``timings``.
 
-            PROJECT = settings.PROJECT
+        """
+        start = time.time()
+        run_detections = Detection.objects.filter(run=run, accepted=True)  # Accepted detections that are not yet sources
 
-            run = run_list[0]
-            run_detections = Detection.objects.filter(run=run, accepted=True)  # Accepted detections that are not yet sources
+        if run_detections.filter(unresolved=True).exists():
+            raise Exception(
+                f'There cannot be any unresolved detections for the run {run.name} '
+                f'at the time of running external cross matching.'
+            )
 
-            if any([d.unresolved for d in run_detections]):
-                raise Exception('There cannot be any unresolved detections for the run at the time of running external cross matching.')
+        detections = DetectionSet.from_queryset(run_detections)
+        catalogue = released.exclude_run(run.name)
+        name_runs = released_name_runs(catalogue.source_names)
+        timings['load'] = timings.get('load', 0.0) + time.time() - start
+
+        logging.info(
+            f'External cross matching applied in {run.name} to {len(detections)} detections '
+            f'against {len(catalogue)} sources'
+        )
+        start = time.time()
+        if settings.CROSS_MATCH_PROCESSES > 1:
+            result = parallel_external_match(
+                detections, catalogue, run_components, name_runs, settings.CROSS_MATCH_PROCESSES
+            )
+        else:
+            result = external_match(detections, catalogue, run_components, name_runs)
+        timings['match'] = time.time() - start
+        logging.info(f"External cross matching completed in {round(timings['match'], 2)} seconds")
+        return detections, catalogue, result
 
-            # Detections from run must enter into one of these lists
-            accepted_detections = []
-            all_rename_detections = []
-            external_conflicts = []
+    def _release_name_check(self, run, detections, result, timings):
+        """Release names of the accepted detections and the names among them
+        already held by released sources of other runs.
 
-            logging.info(f'External cross matching applied in {run.name} to {len(run_detections)} detections')
-            start = time.time()
-            for idx, d in enumerate(run_detections):
-                auto_rename = False
-                auto_delete = False
-                matches = []
-                delete_detections = []
-                rename_detections = []
-
-                # Compare against close detections (accepted) from other runs.
-                # TODO: Fix this threshold for the poles with delta RA (cosine factor)
-                close_detections = Detection.objects.filter(
-                    accepted=True,
-                    source_name__isnull=False,
-                    ra__range=(d.ra - SEARCH_THRESHOLD, d.ra + SEARCH_THRESHOLD),
-                    dec__range=(d.dec - SEARCH_THRESHOLD, d.dec + SEARCH_THRESHOLD),
-                ).exclude(run=run)
-
-                for d_ext in list(set(close_detections)):
-                    # Require official released source.
-                    # TODO: require associated tag?
-                    if PROJECT not in d_ext.source_name:
-                        continue
-
-                    # Auto-delete check on tighter threshold values
-                    if self._is_match(d, d_ext, thresh_spat=thresh_spat_auto, thresh_spec=thresh_spec_auto):
-                        # Logic: delete if in same survey component or reassign to existing source otherwise.
-                        delete = False
-                        for runs in survey_components.values():
-                            if set([d.run.name, d_ext.run.name]).issubset(set(runs)):
-                                delete = True
-                        if delete:
-                            auto_delete = True
-                            delete_detections.append(d_ext)
-                        else:
-                            auto_rename = True
-                            rename_detections.append((d, d_ext))
-
-                    # Otherwise mark for manual resolution
-                    elif self._is_match(d, d_ext, thresh_spat=thresh_spat, thresh_spec=thresh_spec):
-                        matches.append(d_ext)
-
-                # Possible action for this detection
-                if auto_delete:
-                    logging.info(f'[{idx+1}/{len(run_detections)}] {d.name} to be automatically deleted. Conflict: {delete_detections}')
-
-                if auto_rename and not auto_delete:
-                    if len(rename_detections) > 1:
-                        logging.error(f'Multiple rename sources: {rename_detections}')
-                        raise Exception('Should not be able to rename a detection to more than one source (existing database conflict to resolve).')
-
-                    # Check other detections pointing to rename source in same survey component
-                    conflict_in_survey_component = False
-                    d_cur, d_ext = rename_detections[0]
-                    ds = Detection.objects.filter(source_name=d_ext.source_name)
-                    for d in ds:
-                        if set([d_cur.run.name, d.run.name]).issubset(set(runs)):
-                            conflict_in_survey_component = True
-                            logging.info(f'Cannot rename detection {d_cur.name} to {d_ext.source_name} due to potential conflict {d.name} in same survey component.')
-                            logging.info(f'Creating external conflict {d_cur.name} to detection {d.name}')
-                            external_conflicts.append({
-                                'run': run,
-                                'detection': d_cur,
-                                'conflict_detection': d_ext
-                            })
-                    if not conflict_in_survey_component:
-                        all_rename_detections += rename_detections
-                        logging.info(f'[{idx+1}/{len(run_detections)}] {d.name} to be automatically renamed to {d_ext.source_name} [{d_ext.run.name}]')
-
-                if not auto_rename and not auto_delete and matches:
-                    logging.info(f'[{idx+1}/{len(run_detections)}] Matches found for {d.name}: {matches} to resolve manually')
-                    for d_ext_match in matches:
-                        external_conflicts.append({
-                            'run': run,
-                            'detection': d,
-                            'conflict_detection': d_ext_match
-                        })
-                if not auto_rename and not auto_delete and not matches:
-                    accepted_detections.append(d)
-                    logging.info(f'[{idx+1}/{len(run_detections)}] {d.name} will be accepted')
-
-            end = time.time()
-            logging.info(f"External cross matching completed in {round(end - start, 2)} seconds")
-
-            # Release name check
-            accepted_source_names = set([get_release_name(d.name) for d in accepted_detections])
-            existing_names = set([d.source_name for d in Detection.objects.filter(accepted=True, source_name__isnull=False).exclude(run=run)])
-            if accepted_source_names & existing_names:
-                logging.error('External cross matching failed - release name already exists for accepted detection.')
-                raise Exception(f'Attempting to rename to: {accepted_source_names.intersection(existing_names)}')
-
-            logging.info("Writing updates to database")
-            # Accepted sources
-            for d in accepted_detections:
-                d.source_name = get_release_name(d.name)
-                d.save()
-
-            # Renaming
-            logging.info(f'Renaming: {all_rename_detections}')
-            for (d, new_d) in all_rename_detections:
-                # Check if deleted in this run
-                logging.info(f'Database update: Renaming {d.source_name} to {new_d.source_name}')
-                d.source_name = new_d.source_name
-                d.save()
+        """
+        start = time.time()
+        release_names = {i: get_release_name(detections.names[i]) for i in result.accepted}
+        existing_names = release_name_collisions(release_names.values(), exclude_run=run)
+        timings['name_check'] = time.time() - start
+        return release_names, existing_names
 
-            # External conflicts
-            for ex_c in external_conflicts:
-                ExternalConflict.objects.get_or_create(**ex_c)
+    @task()
+    def external_cross_match(self, request, queryset):
+        """Run external cross matching for the selected runs in order of
+        creation. Shared state is loaded once and the sources named in each
+        run are folded into it before matching the next run, which gives the
+        same result as cross matching the runs one after another.
 
-            logging.info("Updating database complete")
-            return ValueTaskReturn(f'Completed {run.name} external cross matching')
+        """
+        runs = list(queryset.order_by('created', 'id'))
+        if not runs:
+            raise Exception("No Run(s) selected")
+
+        # Runs of the same survey components are matched one at a time
+        with curation_lock(runs, survey_components=True):
+            # Check to make sure runs are in survey_components
+            run_components = self._get_run_components(runs)
+            released = self._load_released_sources(runs)
+
+            for run in runs:
+                with transaction.atomic():
+                    detections, catalogue, result = self._external_match_run(run, run_components, released, {})
+
+                    # Runs of other survey components may be naming sources at the same time
+                    lock_release_names()
+                    release_names, existing_names = self._release_name_check(run, detections, result, {})
+                    if existing_names:
+                        logging.error(
+                            'External cross matching failed - release name already exists for accepted detection.'
+                        )
+                        raise Exception('Attempting to rename to: ' + '; '.join(
+                            f'{name} (held by {", ".join(f"{d_id} [{run_name}]" for d_id, run_name in held)})'
+                            for name, held in sorted(existing_names.items())
+                        ))
+
+                    logging.info("Writing updates to database")
+                    writeback = WriteBack()
+                    # Accepted sources
+                    for i in result.accepted:
+                        writeback.set_source_name(detections.ids[i], release_names[i])
+
+                    # Renaming
+                    for (i, ext) in result.renamed:
+                        logging.info(
+                            f'Database update: Renaming {detections.source_names[i]} to {catalogue.source_names[ext]}'
+                        )
+                        writeback.set_source_name(detections.ids[i], catalogue.source_names[ext])
+
+                    # External conflicts
+                    for (i, ext) in result.conflicts:
+                        writeback.add_conflict(run.id, detections.ids[i], catalogue.ids[ext])
+
+                    writeback.apply()
+                    logging.info(f"Updating database complete for {run.name}")
+
+                # Newly named sources are visible to the following runs
+                new_names = dict(release_names)
+                new_names.update({i: catalogue.source_names[ext] for i, ext in result.renamed})
+                released = released.fold(detections, new_names, settings.PROJECT)
+
+        return ValueTaskReturn(f'Completed {",".join([r.name for r in runs])} external cross matching')
 
     def _external_cross_match(self, request, queryset):
         """Run the external cross matching workflow to identify sources
@@ -1137,14 +1219,79 @@ class RunAdmin(ModelAdmin):
 
     _external_cross_match.short_description = 'External cross matching'
 
+    @task()
+    def external_cross_match_preview(self, request, queryset):
+        """Dry run of external cross matching. Takes no locks and writes no
+        detections, returns a CSV report of the decisions instead.
+
+        """
+        if queryset.count() != 1:
+            raise Exception("Only one run can be selected at a time for external cross matching preview.")
+
+        run = queryset.first()
+        timings = {}
+        start = time.time()
+        run_components = self._get_run_components([run])
+        timings['survey_components'] = time.time() - start
+        start = time.time()
+        released = self._load_released_sources([run])
+        timings['load'] = time.time() - start
+        detections, catalogue, result = self._external_match_run(run, run_components, released, timings)
+        release_names, existing_names = self._release_name_check(run, detections, result, timings)
+
+        uuid_filename = f"/tmp/{uuid.uuid4()}.csv"
+        with open(uuid_filename, 'w', newline='') as fh:
+            write_report(fh, detections, catalogue, result, release_names, existing_names, timings)
+
+        return FileTaskReturn([uuid_filename])
+
+    def _external_cross_match_preview(self, request, queryset):
+        try:
+            task_id = self.external_cross_match_preview(request, queryset)
+            logging.info(f'Created task {task_id} for external cross matching preview')
+            return redirect('/admin/survey/task/')
+        except Exception as e:
+            messages.error(request, str(e))
+
+    _external_cross_match_preview.short_description = 'External cross matching (preview)'
+
+    @task()
+    def cross_match_sweep(self, request, queryset):
+        """Count external cross matching outcomes of a run for a grid of
+        thresholds around the defaults. Returns the CSV table, the separation
+        cache is kept by the ``sweep_cross_match_thresholds`` command only.
+
+        """
+        if queryset.count() != 1:
+            raise Exception("Only one run can be selected at a time for a cross matching threshold sweep.")
+
+        run = queryset.first()
+        cache = load_separation_cache(run)
+        rows = cache.sweep()
+
+        uuid_filename = f"/tmp/{uuid.uuid4()}.csv"
+        with open(uuid_filename, 'w', newline='') as fh:
+            write_sweep(fh, rows)
+        return FileTaskReturn([uuid_filename])
+
+    def _cross_match_sweep(self, request, queryset):
+        try:
+            task_id = self.cross_match_sweep(request, queryset)
+            logging.info(f'Created task {task_id} for cross matching threshold sweep')
+            return redirect('/admin/survey/task/')
+        except Exception as e:
+            messages.error(request, str(e))
+
+    _cross_match_sweep.short_description = 'Cross matching threshold sweep'
+
     class ReleaseSourceForm(forms.Form):
         title = 'Release sources for selected runs. Created source names and adds new tag to all sources.'
 
-    @task(exclusive_func_with=['internal_cross_match', 'external_cross_match', 'release_sources', 'delete_run'])
+    @task()
     def release_sources(self, request, queryset, tag):
         PROJECT = settings.PROJECT
 
-        with transaction.atomic():
+        with curation_lock(list(queryset), survey_components=True), transaction.atomic():
             for run in queryset:
                 logging.info(f"Preparing release for run {run.name}")
 
@@ -1152,30 +1299,27 @@ class RunAdmin(ModelAdmin):
                 release_detections = detections.filter(accepted=True, source_name__isnull=False)
                 reject_detections = detections.filter(accepted=True, source_name__isnull=True)  # NOTE: there shouldn't be any of these
 
-                if len(ExternalConflict.objects.filter(run_id=run.id)) != 0:
+                if ExternalConflict.objects.filter(run_id=run.id).exists():
                     raise Exception('There cannot be any external conflicts when creating release source names.')
-                if any([d.unresolved for d in release_detections]):
+                if release_detections.filter(unresolved=True).exists():
                     raise Exception('There cannot be any unresolved detections when releasing sources.')
 
+                writeback = WriteBack()
+
                 # Release sources
-                logging.info(f"{len(release_detections)} detections to release")
-                for idx, d in enumerate(release_detections):
-                    existing = TagDetection.objects.filter(tag=tag, detection=d)
-                    if not existing:
-                        logging.info(f'[{idx+1}/{len(release_detections)}] Creating TagDetection entry for Source {d.source_name}')
-                        TagDetection.objects.create(
-                            tag=tag,
-                            detection=d,
-                            author=str(request.user))
-                    else:
-                        logging.info(f'Tag already created for Source {d.source_name}')
+                release_ids = list(release_detections.values_list('id', flat=True))
+                logging.info(f"{len(release_ids)} detections to release")
+                for d_id in release_ids:
+                    writeback.add_tag(tag, d_id, str(request.user))
 
                 # Delete sources
-                logging.info(f'De-selecting remaining detections {len(reject_detections)}')
-                for idx, d in enumerate(reject_detections):
-                    logging.info(f'[{idx+1}/{len(reject_detections)}] Rejecting detection {d.name}')
-                    d.accepted = False
-                    d.save()
+                reject_ids = list(reject_detections.values_list('id', flat=True))
+                logging.info(f'De-selecting remaining detections {len(reject_ids)}')
+                for d_id in reject_ids:
+                    writeback.set_accepted(d_id, False)
+
+                writeback.apply()
+                update_released_sources(release_ids)
 
                 logging.info("Release completed")
 
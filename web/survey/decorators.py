@@ -5,6 +5,7 @@ from django.conf import settings
 from django.contrib.admin import helpers
 from django.template.response import TemplateResponse
 from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User, Group
 from django.core.exceptions import ObjectDoesNotExist
@@ -185,3 +186,20 @@ def basic_auth(view):
             response['WWW-Authenticate'] = 'Basic realm="AusSRC"'
             return response
     return wrap
+
+
+# decorator for cacheable views
+def cacheable(max_age):
+    """Mark successful and not modified responses of a view with an ETag
+    as cacheable by clients and shared caches for ``max_age`` seconds.
+
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if response.status_code in (200, 206, 304) and response.has_header('ETag'):
+                patch_cache_control(response, public=True, max_age=max_age)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,171 @@
+import json
+import subprocess
+import numpy as np
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from survey.models import Run, Detection, ReleasedSource
+from survey.utils.benchmark import SyntheticSurvey, Benchmark
+from survey.utils.columns import read_columns
+from survey.utils.components import get_survey_component_index, invalidate_survey_component_index
+from survey.utils.crossmatch import DetectionSet, external_match, parallel_external_match
+from survey.utils.match import internal_pairs, match_pairs, match_groups, THRESH_SPAT
+from survey.utils.neighbours import build_neighbours, run_pairs
+from survey.utils.released import released_name_runs
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+# Synthetic runs are written to the configured database, only local servers are accepted
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1', '::1')
+
+
+def _local_database():
+    host = connection.settings_dict.get('HOST') or ''
+    return host in LOCAL_HOSTS or host.startswith('/')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the cross matching stages on synthetic surveys. ' \
+           'Synthetic data is written to the database and rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--detections', type=int, nargs='+', default=[1000, 10000], help='Survey sizes to benchmark.'
+        )
+        parser.add_argument('--runs', type=int, default=4)
+        parser.add_argument('--components', type=int, default=2)
+        parser.add_argument('--duplicate-fraction', type=float, default=0.05)
+        parser.add_argument('--overlap-fraction', type=float, default=0.1)
+        parser.add_argument('--density', type=float, default=100.0, help='Detections per square degree.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--sample', type=int, default=1000,
+            help='Number of pairs for the per pair is_match and sanity_check stages.'
+        )
+        parser.add_argument('--processes', type=int, default=settings.CROSS_MATCH_PROCESSES)
+        parser.add_argument(
+            '--neighbours', action='store_true', help='Also build and read the detection neighbour table.'
+        )
+        parser.add_argument(
+            '--no-memory', action='store_true', help='Do not trace memory, tracing slows down Python code.'
+        )
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic survey in the database.')
+        parser.add_argument('--output', help='JSON output file, stdout if not given.')
+
+    def handle(self, *args, **options):
+        if not _local_database():
+            raise CommandError(
+                f'Database host {connection.settings_dict["HOST"]} is not local, '
+                'run the benchmark against a local scratch database.'
+            )
+        results = []
+        for n in options['detections']:
+            survey = SyntheticSurvey(
+                n, options['runs'], options['components'], options['duplicate_fraction'],
+                options['overlap_fraction'], options['density'], options['seed']
+            )
+            bench = Benchmark(trace_memory=not options['no_memory'])
+            with transaction.atomic():
+                self._run(survey, bench, options)
+                if not options['keep']:
+                    transaction.set_rollback(True)
+            invalidate_survey_component_index(Run)
+            results.append({'parameters': survey.parameters(), 'stages': bench.stages})
+
+        output = json.dumps({
+            'created': datetime.now().isoformat(),
+            'commit': _commit(),
+            'processes': options['processes'],
+            'results': results
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def _run(self, survey, bench, options):
+        with bench.stage('generate') as info:
+            info['rows'] = survey.generate()
+
+        run = Run.objects.get(id=survey.target_run_id)
+        run_detections = Detection.objects.filter(run=run, accepted=True).order_by('id')
+
+        if options['neighbours']:
+            with bench.stage('build_neighbours') as info:
+                info['rows'] = build_neighbours(run)
+
+        # Internal cross matching
+        with bench.stage('internal_load') as info:
+            fields = ('id', 'ra', 'dec', 'freq', 'x', 'y', 'z', 'err_x', 'err_y', 'err_z')
+            columns = read_columns(run_detections, {f: 'i' if f == 'id' else 'f' for f in fields})
+            ids, ra, dec, freq, x, y, z, err_x, err_y, err_z = (columns[f] for f in fields)
+            info['rows'] = len(ids)
+
+        with bench.stage('internal_pairs') as info:
+            idx_i, idx_j = internal_pairs(ra, dec, freq)
+            info['pairs'] = len(idx_i)
+
+        if options['neighbours']:
+            with bench.stage('internal_pairs_neighbour_table') as info:
+                info['pairs'] = len(run_pairs(run, ids, ra, dec, freq, accepted=True)[0])
+
+        with bench.stage('is_match') as info:
+            matched = match_pairs(x, y, z, err_x, err_y, err_z, idx_i, idx_j)
+            info['pairs'] = len(idx_i)
+            info['matches'] = int(matched.sum())
+
+        with bench.stage('sanity_check') as info:
+            verdicts = Detection.sanity_check_pairs(run_detections, list(zip(idx_i[matched], idx_j[matched])))
+            info['pairs'] = len(verdicts)
+            info['passed'] = sum(1 for v in verdicts if v[2])
+
+        with bench.stage('auto_resolve_groups') as info:
+            labels = match_groups(len(ids), idx_i[matched], idx_j[matched])
+            info['groups'] = int(np.sum(np.bincount(labels) > 1))
+
+        # Per pair methods on a sample of the candidate pairs
+        sample = min(options['sample'], len(idx_i))
+        objects = {d.id: d for d in run_detections.filter(
+            id__in=np.union1d(ids[idx_i[:sample]], ids[idx_j[:sample]]).astype(np.int64).tolist()
+        ).select_related('run')}
+        pairs = [(objects[int(ids[i])], objects[int(ids[j])]) for i, j in zip(idx_i[:sample], idx_j[:sample])]
+        with bench.stage('is_match_per_pair') as info:
+            info['pairs'] = len(pairs)
+            info['matches'] = sum(1 for a, b in pairs if a.is_match(b))
+        with bench.stage('sanity_check_per_pair') as info:
+            info['pairs'] = len(pairs)
+            info['passed'] = sum(1 for a, b in pairs if a.sanity_check(b)[0])
+
+        # External cross matching
+        with bench.stage('external_load') as info:
+            run_components = get_survey_component_index(refresh=True).run_components
+            detections = DetectionSet.from_queryset(run_detections)
+            catalogue = DetectionSet.from_queryset(
+                ReleasedSource.objects.filter(
+                    source_name__contains=settings.PROJECT
+                ).exclude(run=run).near(run_detections, THRESH_SPAT),
+                fields=DetectionSet.RELEASED_FIELDS
+            )
+            name_runs = released_name_runs(catalogue.source_names)
+            info['detections'] = len(detections)
+            info['catalogue'] = len(catalogue)
+
+        with bench.stage('external_match') as info:
+            result = external_match(detections, catalogue, run_components, name_runs)
+            info.update(accepted=len(result.accepted), renamed=len(result.renamed),
+                        deleted=len(result.deleted), conflicts=len(result.conflicts))
+
+        if options['processes'] > 1:
+            with bench.stage('external_match_parallel') as info:
+                result = parallel_external_match(detections, catalogue, run_components, name_runs, options['processes'])
+                info['processes'] = options['processes']
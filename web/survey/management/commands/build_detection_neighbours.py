@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from survey.models import Run
+from survey.utils.neighbours import build_neighbours, neighbours_built
+
+
+class Command(BaseCommand):
+    help = 'Build the detection neighbour table for runs. Run after ingesting a run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('runs', nargs='*', help='Run names.')
+        parser.add_argument(
+            '--missing', action='store_true',
+            help='Build for all runs that have no neighbours yet or had detections added since.'
+        )
+        parser.add_argument('--radius', type=float, default=settings.NEIGHBOUR_RADIUS, help='Outer radius (arcsec).')
+
+    def handle(self, *args, **options):
+        if options['missing']:
+            runs = Run.objects.filter(id__in=[r.id for r in Run.objects.all() if not neighbours_built([r], 0)])
+        else:
+            runs = Run.objects.filter(name__in=options['runs'])
+            missing = set(options['runs']) - {r.name for r in runs}
+            if missing:
+                raise CommandError(f'Runs do not exist: {sorted(missing)}')
+
+        for run in runs.order_by('created', 'id'):
+            with transaction.atomic():
+                count = build_neighbours(run, options['radius'])
+            self.stdout.write(f'Built {count} detection neighbours for run {run.name}')
@@ -0,0 +1,68 @@
+import time
+import numpy as np
+from astropy.table import Table
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from survey.models import Run, Detection
+from survey.utils.match import SkyIndex
+from survey.utils.columns import read_columns
+
+
+class Command(BaseCommand):
+    help = 'Match the detections of DINGO runs to their nearest objects in a local GAMA catalogue (FITS or CSV).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('catalogue', help='GAMA catalogue file (FITS or CSV).')
+        parser.add_argument('runs', nargs='+', help='Run names.')
+        parser.add_argument('--radius', type=float, default=30.0, help='Maximum separation (arcsec).')
+        parser.add_argument(
+            '--count', type=int, default=1, help='Number of nearest GAMA objects to keep for each detection.'
+        )
+        parser.add_argument('--id-column', default='CATAID')
+        parser.add_argument('--ra-column', default='RAcen')
+        parser.add_argument('--dec-column', default='Deccen')
+
+    def handle(self, *args, **options):
+        if settings.PROJECT != 'DINGO':
+            raise CommandError('Nearest GAMA matching is only available for DINGO.')
+        from survey.models import DetectionNearestGAMA
+
+        runs = Run.objects.filter(name__in=options['runs'])
+        missing = set(options['runs']) - {r.name for r in runs}
+        if missing:
+            raise CommandError(f'Runs do not exist: {sorted(missing)}')
+
+        start = time.time()
+        path = options['catalogue']
+        table = Table.read(path, format='ascii.csv' if path.lower().endswith('.csv') else None)
+        columns = [options['id_column'], options['ra_column'], options['dec_column']]
+        for c in columns:
+            if c not in table.colnames:
+                raise CommandError(f'Column {c} not in catalogue, available columns: {table.colnames}')
+        cata_id = np.asarray(table[columns[0]], dtype=np.int64)
+        index = SkyIndex(
+            np.asarray(table[columns[1]], dtype=np.float64), np.asarray(table[columns[2]], dtype=np.float64)
+        )
+        self.stdout.write(f'Loaded {len(index)} GAMA objects in {round(time.time() - start, 2)} seconds')
+
+        for run in runs.order_by('created', 'id'):
+            start = time.time()
+            columns = read_columns(Detection.objects.filter(run=run), {'id': 'i', 'ra': 'f', 'dec': 'f'})
+            ids, ra, dec = columns['id'], columns['ra'], columns['dec']
+            if not len(ids):
+                continue
+            q, c, _ = index.nearest(ra, dec, options['radius'], k=options['count'])
+            matches = [
+                DetectionNearestGAMA(detection_id_id=int(ids[i]), cata_id=int(cata_id[j]))
+                for i, j in zip(q, c)
+            ]
+            with transaction.atomic():
+                DetectionNearestGAMA.objects.filter(detection_id__run=run).delete()
+                DetectionNearestGAMA.objects.bulk_create(matches, batch_size=1000)
+            self.stdout.write(
+                f'Matched {len(set(q.tolist()))} of {len(ids)} detections in run {run.name} '
+                f'to {len(matches)} GAMA objects in {round(time.time() - start, 2)} seconds'
+            )
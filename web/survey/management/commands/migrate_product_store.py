@@ -0,0 +1,68 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F, Func, IntegerField
+
+from survey.models import Product, ProductFile
+from survey.utils.products import BlobReader
+from survey.utils.store import store_enabled, write_blob
+
+
+# Products that can be moved, the rest are read by the admin pages
+STORE_PRODUCTS = ('cube', 'mask', 'chan', 'mom1', 'mom2', 'snr', 'pv')
+
+
+class Command(BaseCommand):
+    help = 'Move product blobs from the product table to the content addressed product store (PRODUCT_STORE).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', nargs='+', choices=STORE_PRODUCTS, default=['cube', 'mask', 'chan'])
+        parser.add_argument('--runs', nargs='+', help='Run names, all runs if not given.')
+        parser.add_argument('--keep', action='store_true', help='Keep the blobs in the product table.')
+        parser.add_argument(
+            '--prune', action='store_true', help='Only remove files from the store that no product refers to.'
+        )
+
+    def handle(self, *args, **options):
+        if not store_enabled():
+            raise CommandError('PRODUCT_STORE is not set.')
+        os.makedirs(settings.PRODUCT_STORE, exist_ok=True)
+        if options['prune']:
+            self._prune()
+            return
+
+        products = Product.objects.all()
+        if options['runs']:
+            products = products.filter(detection__run__name__in=options['runs'])
+
+        for name in options['products']:
+            rows = list(products.filter(**{f'{name}__isnull': False}).annotate(
+                size=Func(F(name), function='octet_length', output_field=IntegerField())
+            ).order_by('id').values_list('id', 'size'))
+            total = 0
+            for product_id, size in rows:
+                with transaction.atomic():
+                    checksum, size = write_blob(BlobReader(product_id, name, size))
+                    ProductFile.objects.update_or_create(
+                        product_id=product_id, name=name,
+                        defaults={'checksum': checksum, 'size': size}
+                    )
+                    if not options['keep']:
+                        with connection.cursor() as cursor:
+                            cursor.execute(f'UPDATE product SET {name} = NULL WHERE id = %s', [product_id])
+                total += size
+            self.stdout.write(
+                f'Moved {len(rows)} {name} products ({round(total / 2**20, 1)} MiB) to {settings.PRODUCT_STORE}'
+            )
+
+    def _prune(self):
+        checksums = set(ProductFile.objects.values_list('checksum', flat=True).distinct())
+        removed = 0
+        for root, _, files in os.walk(settings.PRODUCT_STORE):
+            for f in files:
+                # Temporary files of blobs being written start with a dot
+                if not f.startswith('.') and f not in checksums:
+                    os.remove(os.path.join(root, f))
+                    removed += 1
+        self.stdout.write(f'Removed {removed} files from {settings.PRODUCT_STORE}')
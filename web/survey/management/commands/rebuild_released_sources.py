@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from survey.utils.released import rebuild_released_sources
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the released source index used for external cross matching.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_released_sources()
+        self.stdout.write(f'Released source index contains {count} sources')
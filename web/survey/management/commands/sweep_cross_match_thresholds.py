@@ -0,0 +1,65 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from survey.models import Run
+from survey.utils.crossmatch import SeparationCache, SWEEP_GRID, write_sweep
+from survey.utils.match import THRESH_SPAT, THRESH_SPEC
+from survey.utils.sweep import load_separation_cache
+
+
+def _values(s):
+    return [float(v) for v in s.split(',')]
+
+
+class Command(BaseCommand):
+    help = 'Count external cross matching outcomes of a run over a grid of thresholds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('run', help='Run name.')
+        parser.add_argument('--cache', help='Separation cache file (.npz), created if it does not exist.')
+        parser.add_argument('--refresh', action='store_true', help='Recompute the separation cache.')
+        parser.add_argument('--radius', type=float, default=2 * THRESH_SPAT,
+                            help='Outer spatial radius of the cache (arcsec).')
+        parser.add_argument('--max-spec', type=float, default=2 * THRESH_SPEC,
+                            help='Outer spectral separation of the cache (Hz).')
+        for name, values in SWEEP_GRID.items():
+            parser.add_argument(
+                f"--{name.replace('thresh_', '').replace('_', '-')}", dest=name, type=_values,
+                default=values, help=f"Comma separated {name} values (default {','.join(map(str, values))})."
+            )
+        parser.add_argument('--output', help='CSV output file, stdout if not given.')
+
+    def handle(self, *args, **options):
+        run = Run.objects.filter(name=options['run']).first()
+        if run is None:
+            raise CommandError(f"Run {options['run']} does not exist.")
+
+        start = time.time()
+        cache_file = options['cache']
+        if cache_file and os.path.exists(cache_file) and not options['refresh']:
+            cache = SeparationCache.load(cache_file)
+            if cache.run_id != run.id:
+                raise CommandError(f'Cache {cache_file} does not belong to run {run.name}, use --refresh to recompute.')
+        else:
+            cache = load_separation_cache(run, options['radius'], options['max_spec'])
+            if cache_file:
+                cache.save(cache_file)
+        self.stderr.write(
+            f'Loaded {len(cache.sep)} candidate pairs for {cache.n} detections '
+            f'in {round(time.time() - start, 2)} seconds'
+        )
+
+        start = time.time()
+        try:
+            rows = cache.sweep({name: options[name] for name in SWEEP_GRID})
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stderr.write(f'Evaluated {len(rows)} threshold settings in {round(time.time() - start, 3)} seconds')
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as fh:
+                write_sweep(fh, rows)
+        else:
+            write_sweep(self.stdout, rows)
@@ -1,5 +1,4 @@
 import os
-import math
 import json
 import cv2
 import numpy as np
@@ -13,6 +12,7 @@ from enum import IntEnum
 from io import BytesIO, StringIO
 from astropy.io import fits
 from django.db import models
+from django.db.models.expressions import RawSQL
 from django.contrib.postgres.fields import ArrayField
 from django.utils.safestring import mark_safe
 from django.urls import reverse
@@ -22,6 +22,9 @@ from django.conf import settings
 
 from survey.utils.fields import PostgresDecimalField
 from survey.utils.plot import product_summary_image
+from survey.utils.match import match_pairs
+from survey.utils.columns import read_columns
+from survey.utils.store import store_path, store_url, FileBlob
 
 
 matplotlib.use('Agg')
@@ -182,6 +185,45 @@ class Instance(models.Model):
         unique_together = (('run', 'filename', 'boundary'),)
 
 
+class SkyQuerySet(models.QuerySet):
+    """Spatial queries on the pg_sphere ``pos`` column of a table, which is
+    backed by a GiST index. Positions are in degrees, radii in arcsec.
+
+    """
+    def _pos(self):
+        return f'"{self.model._meta.db_table}"."pos"'
+
+    def _where(self, sql, params):
+        return self.filter(RawSQL(sql, params, output_field=models.BooleanField()))
+
+    def cone(self, ra, dec, radius):
+        """Rows within radius of a position.
+
+        """
+        return self._where(
+            f'{self._pos()} <@ scircle(spoint(radians(%s), radians(%s)), radians(%s / 3600.0))',
+            [float(ra), float(dec), float(radius)]
+        )
+
+    def cone_freq(self, ra, dec, radius, freq, dfreq):
+        """Rows within radius of a position and dfreq (Hz) of a frequency.
+
+        """
+        return self.cone(ra, dec, radius).filter(freq__range=(float(freq) - dfreq, float(freq) + dfreq))
+
+    def near(self, queryset, radius):
+        """Rows within radius of any row in queryset.
+
+        """
+        opts = queryset.model._meta
+        sql, params = queryset.order_by().values('pk').query.sql_with_params()
+        return self._where(
+            f'EXISTS (SELECT 1 FROM "{opts.db_table}" n WHERE n."{opts.pk.column}" IN ({sql}) '
+            f'AND {self._pos()} <@ scircle(n."pos", radians(%s / 3600.0)))',
+            [*params, float(radius)]
+        )
+
+
 class Detection(models.Model):
     """Auto-generated Django model for detection table.
 
@@ -243,95 +285,141 @@ class Detection(models.Model):
     v_opt_peak = PostgresDecimalField(null=True)
     v_app_peak = PostgresDecimalField(null=True)
 
+    objects = SkyQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
+    MATCH_FIELDS = ('id', 'run_id', 'x', 'y', 'z', 'err_x', 'err_y', 'err_z',
+                    'f_sum', 'ell_maj', 'ell_min', 'w20', 'w50')
+
+    # (field, sanity threshold key, index into threshold) in the order they are checked
+    SANITY_CHECKS = (('f_sum', 'flux', None),
+                     ('ell_maj', 'spatial_extent', 1), ('ell_min', 'spatial_extent', 0),
+                     ('w20', 'spectral_extent', 1), ('w50', 'spectral_extent', 0))
+
+    @classmethod
+    def _arrays(cls, detections):
+        """Columns needed for matching of a queryset or list of detections as arrays.
+
+        """
+        if isinstance(detections, models.QuerySet):
+            types = {f: 'i' if f in ('id', 'run_id') else 'f' for f in cls.MATCH_FIELDS}
+            return read_columns(detections, types)
+        rows = [tuple(getattr(d, f) for f in cls.MATCH_FIELDS) for d in detections]
+        columns = zip(*rows) if rows else [()] * len(cls.MATCH_FIELDS)
+        arrays = {f: np.array(c, dtype=np.float64) for f, c in zip(cls.MATCH_FIELDS, columns)}
+        arrays['id'] = arrays['id'].astype(np.int64)
+        arrays['run_id'] = arrays['run_id'].astype(np.int64)
+        return arrays
+
+    @staticmethod
+    def _run_thresholds(run_ids):
+        return dict(Run.objects.filter(id__in=set(run_ids.tolist())).values_list('id', 'sanity_thresholds'))
+
+    @classmethod
+    def match_matrix(cls, detections, sanity_thresholds=None):
+        """Batch version of ``is_match`` for detections of a single run.
+
+        Returns the detection ids and a symmetric boolean matrix of matches,
+        the diagonal is False. The run sanity thresholds are loaded once if
+        not given. Raises ValueError for pairs at the same spatial but
+        different spectral position, for which the test is undefined.
+
+        """
+        a = cls._arrays(detections)
+        n = len(a['id'])
+        if len(set(a['run_id'].tolist())) > 1:
+            raise ValueError('Detections belong to different runs.')
+        if n < 2:
+            return a['id'], np.zeros((n, n), dtype=bool)
+        if sanity_thresholds is None:
+            sanity_thresholds = cls._run_thresholds(a['run_id'])[a['run_id'][0]]
+        sigma = sanity_thresholds.get('uncertainty_sigma', 5)
+
+        i, j = np.triu_indices(n, 1)
+        # The spatial test is undefined for pairs at the same spatial but different spectral position
+        undefined = (a['x'][i] == a['x'][j]) & (a['y'][i] == a['y'][j]) & (a['z'][i] != a['z'][j])
+        if undefined.any():
+            k = int(np.argmax(undefined))
+            raise ValueError(f"Detections {a['id'][i[k]]} and {a['id'][j[k]]} are at the same spatial position.")
+        matched = match_pairs(a['x'], a['y'], a['z'], a['err_x'], a['err_y'], a['err_z'], i, j, sigma)
+        matrix = np.zeros((n, n), dtype=bool)
+        matrix[i, j] = matched
+        matrix[j, i] = matched
+        return a['id'], matrix
+
+    @classmethod
+    def sanity_check_pairs(cls, detections, pairs=None, sanity_thresholds=None):
+        """Batch version of ``sanity_check``.
+
+        ``pairs`` are (i, j) index pairs into ``detections``, all pairs if not
+        given. Returns a list of (id, id, passed, reason) in the order of the
+        pairs. Sanity thresholds are loaded once per run if not given.
+
+        """
+        a = cls._arrays(detections)
+        n = len(a['id'])
+        if pairs is None:
+            i, j = np.triu_indices(n, 1)
+        else:
+            i = np.array([p for p, _ in pairs], dtype=np.int64)
+            j = np.array([q for _, q in pairs], dtype=np.int64)
+        if sanity_thresholds is None:
+            thresholds = cls._run_thresholds(a['run_id'])
+        else:
+            thresholds = {r: sanity_thresholds for r in set(a['run_id'].tolist())}
+
+        # Percentage difference of each checked property, one row per check
+        with np.errstate(divide='ignore', invalid='ignore'):
+            diffs = np.array([
+                np.abs(a[f][i] - a[f][j]) * 100 / ((np.abs(a[f][i]) + np.abs(a[f][j])) / 2)
+                for f, _, _ in cls.SANITY_CHECKS
+            ]).reshape(len(cls.SANITY_CHECKS), len(i))
+        limits = np.array([
+            [thresholds[r][key] if k is None else thresholds[r][key][k] for r in a['run_id'][i].tolist()]
+            for _, key, k in cls.SANITY_CHECKS
+        ], dtype=np.float64).reshape(diffs.shape)
+        failed = diffs > limits
+        first = np.argmax(failed, axis=0)
+
+        verdicts = []
+        for k, (p, q) in enumerate(zip(i.tolist(), j.tolist())):
+            id_p, id_q = int(a['id'][p]), int(a['id'][q])
+            if id_p == id_q:
+                verdicts.append((id_p, id_q, False, 'Same detection.'))
+            elif a['run_id'][p] != a['run_id'][q]:
+                verdicts.append((id_p, id_q, False, f'Detections {id_p} and {id_q} belong to different runs.'))
+            elif failed[first[k], k]:
+                c = first[k]
+                var = 'flux' if c == 0 else f'{cls.SANITY_CHECKS[c][0]} Check:'
+                verdicts.append((id_p, id_q, False, f"Detections: {id_p}, {id_q} Var: {var} "
+                                                    f"{round(diffs[c, k], 2)}% > {limits[c, k]:g}%"))
+            else:
+                verdicts.append((id_p, id_q, True, None))
+        return verdicts
+
     def sanity_check(self, detect):
-        logging.info(f'Running sanity check between detections {self.id} and {detect.id}')
         if self.id == detect.id:
             return False, 'Same detection.'
 
-        if self.run.id != detect.run.id:
+        if self.run_id != detect.run_id:
             return False, f'Detections {self.id} and {detect.id} belong to different runs.'
 
-        sanity_thresholds = self.run.sanity_thresholds
-
-        f1 = self.f_sum
-        f2 = detect.f_sum
-        flux_threshold = sanity_thresholds['flux']
-        diff = abs(f1 - f2) * 100 / ((abs(f1) + abs(f2)) / 2)
-        logging.info(f'Flux comparison: {f1} vs {f2}. Difference: {diff}')
-        logging.info(f'Flux threshold: {flux_threshold}')
-
-        if diff > flux_threshold:
-            message = f"Detections: {self.id}, {detect.id} \
-                Var: flux {round(diff, 2)}% > {flux_threshold}%"
-            return False, message
-
-        min_extent, max_extent = sanity_thresholds['spatial_extent']
-        max1 = self.ell_maj
-        max2 = detect.ell_maj
-        min1 = self.ell_min
-        min2 = detect.ell_min
-
-        max_diff = abs(max1 - max2) * 100 / ((abs(max1) + abs(max2)) / 2)
-        min_diff = abs(min1 - min2) * 100 / ((abs(min1) + abs(min2)) / 2)
-        if max_diff > max_extent:
-            return False, f"Detections: {self.id}, {detect.id} Var: ell_maj " \
-                          f"Check: {round(max_diff, 2)}% > {max_extent}%"
-
-        if min_diff > min_extent:
-            return False, f"Detections: {self.id}, {detect.id} Var: ell_min " \
-                          f"Check: {round(min_diff, 2)}% > {min_extent}%"
-
-        min_extent, max_extent = sanity_thresholds['spectral_extent']
-        max1 = self.w20
-        max2 = detect.w20
-        min1 = self.w50
-        min2 = detect.w50
-        max_diff = abs(max1 - max2) * 100 / ((abs(max1) + abs(max2)) / 2)
-        min_diff = abs(min1 - min2) * 100 / ((abs(min1) + abs(min2)) / 2)
-        if max_diff > max_extent:
-            return False, f"Detections: {self.id}, {detect.id} Var: w20 " \
-                          f"Check: {round(max_diff, 2)}% > {max_extent}%"
-
-        if min_diff > min_extent:
-            return False, f"Detections: {self.id}, {detect.id} Var: w50 " \
-                          f"Check: {round(min_diff, 2)}% > {min_extent}%"
-
-        return True, None
+        _, _, passed, reason = Detection.sanity_check_pairs(
+            [self, detect], sanity_thresholds=self.run.sanity_thresholds
+        )[0]
+        return passed, reason
 
     def is_match(self, detect):
-        logging.info(f'Checking if detections {self.id} and {detect.id} are matches')
         if self.id == detect.id:
             raise ValueError('Same detection.')
 
-        if self.run.id != detect.run.id:
+        if self.run_id != detect.run_id:
             raise ValueError(f'Detections {self.id} and {detect.id} belong to different runs.')
 
-        if self.x == detect.x and self.y == detect.y and self.z == detect.z:
-            return True
-
-        sanity = self.run.sanity_thresholds
-        sigma = sanity.get('uncertainty_sigma', 5)
-        logging.info(f'Allowed uncertainty: {sigma}')
-
-        d_space = math.sqrt(
-            (self.x - detect.x) ** 2 + (self.y - detect.y) ** 2
-        )
-        logging.info(f'Spatial separation: {d_space}')
-        d_space_err = math.sqrt(
-            (self.x - detect.x) ** 2 * (self.err_x ** 2 + detect.err_x ** 2) +
-            (self.y - detect.y) ** 2 * (self.err_y ** 2 + detect.err_y ** 2)) \
-            / ((self.x - detect.x) ** 2 + (self.y - detect.y) ** 2)
-        logging.info(f'Spatial separation error: {d_space_err}')
-        d_spec = abs(self.z - detect.z)
-        logging.info(f'Spectral separation: {d_spec}')
-        d_spec_err = math.sqrt(self.err_z ** 2 + detect.err_z ** 2)
-        logging.info(f'Spectral separation error: {d_spec_err}')
-        logging.info(f'Spatial and spectral tests passing: ({d_space <= sigma * d_space_err}, {d_spec <= sigma * d_spec_err})')
-
-        return d_space <= sigma * d_space_err and d_spec <= sigma * d_spec_err
+        _, matrix = Detection.match_matrix([self, detect], sanity_thresholds=self.run.sanity_thresholds)
+        return bool(matrix[0, 1])
 
     def spectrum_image(self):
         product = self.product_set.only('spec')
@@ -446,6 +534,40 @@ class Product(models.Model):
         db_table = 'product'
         unique_together = (('detection',),)
 
+    def files(self):
+        """Products moved to the product store, by product name.
+
+        """
+        return {f.name: f for f in self.productfile_set.all()}
+
+
+class ProductFile(models.Model):
+    """Product blob moved from the product table to the content addressed
+    product store on the filesystem.
+
+    """
+    id = models.BigAutoField(primary_key=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    name = models.CharField(max_length=16)
+    checksum = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'product_file'
+        unique_together = (('product', 'name'),)
+
+    @property
+    def path(self):
+        return store_path(self.checksum)
+
+    @property
+    def url(self):
+        return store_url(self.checksum)
+
+    def open(self):
+        return FileBlob(self.checksum, self.size)
+
 
 # ------------------------------------------------------------------------------
 # Metadata tables
@@ -493,6 +615,55 @@ class TagDetection(models.Model):
 # ------------------------------------------------------------------------------
 # Operational tables
 
+class ReleasedSource(models.Model):
+    """Persisted index of accepted and named detections used for external
+    cross matching. Maintained by ``survey.utils.released``.
+
+    """
+    detection = models.OneToOneField(Detection, primary_key=True, on_delete=models.CASCADE)
+    run = models.ForeignKey(Run, on_delete=models.CASCADE)
+    source_name = models.TextField()
+    ra = models.FloatField(null=True)
+    dec = models.FloatField(null=True)
+    freq = models.FloatField(null=True)
+
+    objects = SkyQuerySet.as_manager()
+
+    class Meta:
+        managed = False
+        db_table = 'released_source'
+
+
+class DetectionNeighbour(models.Model):
+    """Precomputed neighbours of a detection within the outer radius the
+    neighbours of its run were built with. Separation in arcsec and Hz.
+    Maintained by ``survey.utils.neighbours``.
+
+    """
+    id = models.BigAutoField(primary_key=True)
+    detection = models.ForeignKey(Detection, on_delete=models.CASCADE, related_name='neighbours')
+    neighbour = models.ForeignKey(Detection, on_delete=models.CASCADE, related_name='+')
+    neighbour_run = models.ForeignKey(Run, on_delete=models.CASCADE, related_name='+')
+    sep = models.FloatField()
+    d_freq = models.FloatField(null=True)
+
+    class Meta:
+        managed = False
+        db_table = 'detection_neighbour'
+        unique_together = (('detection', 'neighbour'),)
+
+
+class DetectionNeighbourRun(models.Model):
+    run = models.OneToOneField(Run, primary_key=True, on_delete=models.CASCADE)
+    radius = models.FloatField()
+    max_detection_id = models.BigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        managed = False
+        db_table = 'detection_neighbour_run'
+
+
 class ExternalConflict(models.Model):
     id = models.BigAutoField(primary_key=True)
     run = models.ForeignKey(Run, on_delete=models.CASCADE)
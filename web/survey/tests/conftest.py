@@ -0,0 +1,18 @@
+import django
+from django.conf import settings
+
+
+def pytest_configure():
+    # Unit tests of the survey app run against an in-memory database,
+    # they do not need the deployment settings
+    if not settings.configured:
+        settings.configure(
+            INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth', 'survey'],
+            DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+            DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+            USE_TZ=True,
+            PROJECT='WALLABY',
+            PRODUCT_STORE='',
+            ARCHIVE_CACHE='',
+        )
+        django.setup()
@@ -0,0 +1,47 @@
+import os
+import time
+import fcntl
+
+from survey.utils.archive_cache import ArchiveCache, LOCK_TIMEOUT
+
+
+def build(chunks=(b'abc', b'def')):
+    return lambda: iter(chunks)
+
+
+def test_archive_cache(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1)
+    path, chunks = cache.get('key', build())
+    assert path is None
+    assert b''.join(chunks) == b'abcdef'
+    path, chunks = cache.get('key', build())
+    assert chunks is None
+    with open(path, 'rb') as f:
+        assert f.read() == b'abcdef'
+
+
+def test_archive_cache_lock_timeout(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1)
+    with open(tmp_path / 'key.lock', 'w') as lock:
+        # Another request is building the archive
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        start = time.monotonic()
+        path, chunks = cache.get('key', build(), timeout=0.2)
+        assert time.monotonic() - start < LOCK_TIMEOUT
+        assert path is None
+        assert b''.join(chunks) == b'abcdef'
+    assert not os.path.exists(cache.path('key'))
+
+
+def test_archive_cache_evict_locks(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1)
+    old = time.time() - 2 * LOCK_TIMEOUT
+    for key in ('abandoned', 'building', 'recent', 'cached'):
+        (tmp_path / f'{key}.lock').write_text('')
+        if key != 'recent':
+            os.utime(tmp_path / f'{key}.lock', (old, old))
+    (tmp_path / 'cached.tar.gz').write_bytes(b'abc')
+    with open(tmp_path / 'building.lock', 'r') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ['building.lock', 'cached.lock', 'cached.tar.gz', 'recent.lock']
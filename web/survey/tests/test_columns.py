@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from django.db import connection, models
+from django.test.utils import isolate_apps
+
+from survey.utils.columns import read_columns
+
+
+@pytest.fixture
+def detection_model():
+    with isolate_apps('django.contrib.contenttypes'):
+        class Detection(models.Model):
+            name = models.CharField(max_length=64)
+            run = models.CharField(max_length=64)
+            freq = models.DecimalField(max_digits=20, decimal_places=4, null=True)
+
+            class Meta:
+                app_label = 'contenttypes'
+
+        with connection.schema_editor() as editor:
+            editor.create_model(Detection)
+        try:
+            yield Detection
+        finally:
+            with connection.schema_editor() as editor:
+                editor.delete_model(Detection)
+
+
+def test_read_columns(detection_model):
+    detection_model.objects.bulk_create([
+        detection_model(name='a', run='r1', freq='1400000000.5'),
+        detection_model(name='b', run='r1', freq=None),
+        detection_model(name='c', run='r2', freq='1300000000'),
+    ])
+    queryset = detection_model.objects.order_by('id')
+    columns = read_columns(queryset, {'id': 'i', 'name': 's', 'run': 's', 'freq': 'f'}, chunk_size=2)
+
+    assert columns['id'].dtype == np.int64
+    assert list(columns['id']) == list(queryset.values_list('id', flat=True))
+    assert columns['name'] == ['a', 'b', 'c']
+    assert columns['run'] == ['r1', 'r1', 'r2']
+    assert columns['run'][0] is columns['run'][1]
+    assert columns['freq'].dtype == np.float64
+    assert columns['freq'][0] == 1400000000.5
+    assert np.isnan(columns['freq'][1])
+    assert columns['freq'][2] == 1300000000.0
+
+
+def test_read_columns_empty(detection_model):
+    columns = read_columns(detection_model.objects.all(), {'id': 'i', 'name': 's', 'freq': 'f'})
+    assert len(columns['id']) == 0 and columns['id'].dtype == np.int64
+    assert columns['name'] == []
+    assert len(columns['freq']) == 0 and columns['freq'].dtype == np.float64
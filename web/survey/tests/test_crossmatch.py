@@ -0,0 +1,229 @@
+import numpy as np
+import pytest
+
+from survey.utils.crossmatch import DetectionSet, SeparationCache, external_match, parallel_external_match, \
+    source_name_runs
+
+
+ARCSEC = 1 / 3600.0
+FREQ = 1.4e+9
+
+RUN_COMPONENTS = {'new': {'X'}, 'same': {'X'}, 'other': {'Y'}}
+
+
+def catalogue():
+    # Sources one degree apart, the last one shares its source name with a
+    # detection of another source
+    return DetectionSet(
+        [1, 2, 3, 4, 5],
+        ['c0', 'c1', 'c2', 'c3', 'c4'],
+        ['SRC0', 'SRC1', 'SRC2', 'SRC3', 'SRC3'],
+        ['same', 'other', 'other', 'other', 'same'],
+        [10.0, 11.0, 12.0, 13.0, 20.0],
+        [0.0, 0.0, 0.0, 0.0, 0.0],
+        [FREQ] * 5
+    )
+
+
+def detections():
+    return DetectionSet(
+        [10, 11, 12, 13, 14],
+        ['d0', 'd1', 'd2', 'd3', 'd4'],
+        [None] * 5,
+        ['new'] * 5,
+        [5.0, 10.0 + ARCSEC, 11.0 + ARCSEC, 12.0 + 30 * ARCSEC, 13.0 + ARCSEC],
+        [0.0, 0.0, 0.0, 0.0, 0.0],
+        [FREQ] * 5
+    )
+
+
+def grid_survey(seed=0):
+    """Released sources on a jittered 150 arcsec grid straddling the equator
+    and run detections next to them (auto matched), within the match radius
+    or separated in frequency, so matches cross the declination bands of the
+    parallel matching.
+
+    """
+    rng = np.random.default_rng(seed)
+    ra, dec = np.meshgrid(np.arange(20) * 150 * ARCSEC, (np.arange(20) - 10) * 150 * ARCSEC)
+    ra = ra.ravel() + rng.uniform(-2, 2, ra.size) * ARCSEC
+    dec = dec.ravel() + rng.uniform(-2, 2, dec.size) * ARCSEC
+    n = len(ra)
+    catalogue = DetectionSet(
+        np.arange(n) + 1,
+        [f'c{i}' for i in range(n)],
+        [f'SRC{i % (n - 10)}' for i in range(n)],
+        ['same' if i % 3 == 0 else 'other' for i in range(n)],
+        ra, dec, FREQ + rng.uniform(-0.01e+6, 0.01e+6, n)
+    )
+    m = 150
+    picked = rng.choice(n, m, replace=False)
+    kind = np.arange(m) % 3
+    offset = np.where(kind == 0, 1.0, rng.uniform(-60, 60, m)) * ARCSEC
+    d_freq = np.where(kind == 2, 5e+6, rng.uniform(-0.01e+6, 0.01e+6, m))
+    detections = DetectionSet(
+        np.arange(m) + 1000,
+        [f'd{i}' for i in range(m)],
+        [None] * m,
+        ['new'] * m,
+        ra[picked] + offset, dec[picked] + offset,
+        catalogue.freq[picked] + d_freq
+    )
+    return detections, catalogue
+
+
+def decisions(result):
+    return (
+        [int(i) for i in result.accepted],
+        [(int(i), int(e)) for i, e in result.renamed],
+        [(int(i), [int(e) for e in exts]) for i, exts in result.deleted],
+        sorted((int(i), int(e)) for i, e in result.conflicts),
+        {(int(i), int(e)): v for (i, e), v in result.separations.items()},
+    )
+
+
+@pytest.mark.parametrize('processes', [2, 3])
+def test_parallel_external_match(processes):
+    for dets, cat in (grid_survey(), (detections(), catalogue())):
+        serial = external_match(dets, cat, RUN_COMPONENTS)
+        parallel = parallel_external_match(dets, cat, RUN_COMPONENTS, None, processes)
+        assert decisions(parallel) == decisions(serial)
+
+
+def test_parallel_external_match_seam():
+    # Band edges fall between detections either side of the equator, the
+    # source they match lies in the other band
+    dets = DetectionSet(
+        [10, 11], ['d0', 'd1'], [None, None], ['new', 'new'],
+        [10.0, 10.0], [-30 * ARCSEC, 30 * ARCSEC], [FREQ, FREQ]
+    )
+    cat = DetectionSet(
+        [1, 2], ['c0', 'c1'], ['SRC0', 'SRC1'], ['other', 'other'],
+        [10.0, 10.0], [20 * ARCSEC, -20 * ARCSEC], [FREQ, FREQ]
+    )
+    serial = external_match(dets, cat, RUN_COMPONENTS)
+    assert sorted(serial.conflicts) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert decisions(parallel_external_match(dets, cat, RUN_COMPONENTS, None, 2)) == decisions(serial)
+
+
+def test_external_match():
+    result = external_match(detections(), catalogue(), RUN_COMPONENTS)
+    # Nothing nearby
+    assert result.accepted == [0]
+    # Same position as a source in the same survey component
+    assert result.deleted == [(1, [0])]
+    # Same position as a source in another survey component
+    assert result.renamed == [(2, 1)]
+    # Within the match threshold only, and a rename blocked by a detection
+    # of the same survey component carrying the source name
+    assert sorted((int(d), int(c)) for d, c in result.conflicts) == [(3, 2), (4, 3)]
+    d_arcsec, d_freq = result.separations[(3, 2)]
+    assert abs(d_arcsec - 30.0) < 1e-3 and d_freq == 0.0
+
+
+def test_external_match_spectral_threshold():
+    dets = detections()
+    dets.freq[:] = FREQ + 3e+6
+    result = external_match(dets, catalogue(), RUN_COMPONENTS)
+    assert result.accepted == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.parametrize('thresholds', [
+    {},
+    {'thresh_spat': 20.0},
+    {'thresh_spat_auto': 0.5},
+    {'thresh_spec': 1e+6, 'thresh_spec_auto': 0.01e+6},
+])
+def test_separation_cache_evaluate(thresholds):
+    dets, cat = detections(), catalogue()
+    counts = SeparationCache.build(dets, cat, RUN_COMPONENTS).evaluate(**thresholds)
+    result = external_match(dets, cat, RUN_COMPONENTS, **thresholds)
+    assert counts == {
+        'accepted': len(result.accepted),
+        'deleted': len(result.deleted),
+        'renamed': len(result.renamed),
+        'conflicts': len(result.conflicts),
+        'multiple_renames': 0,
+    }
+
+
+def test_separation_cache_outside_radius():
+    cache = SeparationCache.build(detections(), catalogue(), RUN_COMPONENTS, radius=60.0)
+    with pytest.raises(ValueError):
+        cache.evaluate(thresh_spat=90.0)
+
+
+def overlapping_runs(seed=0):
+    """Released sources of an old run and three new runs observing the same
+    positions, so later runs match sources named by earlier ones.
+
+    """
+    rng = np.random.default_rng(seed)
+    ra = np.repeat(np.arange(8), 8) * 150 * ARCSEC
+    dec = np.tile(np.arange(8) - 4, 8) * 150 * ARCSEC
+    old = rng.choice(len(ra), 10, replace=False)
+    released = DetectionSet(
+        old + 1, [f'o{i}' for i in old], [f'WALLABY O{i}' for i in old], ['old'] * len(old),
+        ra[old], dec[old], np.full(len(old), FREQ)
+    )
+    runs = []
+    for k, run_name in enumerate(['A', 'B', 'C']):
+        picked = np.sort(rng.choice(len(ra), 30, replace=False))
+        offset = np.where(rng.random(30) < 0.7, 1.0, 40.0) * ARCSEC
+        runs.append(DetectionSet(
+            picked + 100 * (k + 1), [f'{run_name}{i}' for i in picked], [None] * 30, [run_name] * 30,
+            ra[picked] + offset, dec[picked], np.full(30, FREQ)
+        ))
+    return released, runs
+
+
+MULTI_RUN_COMPONENTS = {'old': {'Y'}, 'A': {'X'}, 'B': {'Y'}, 'C': {'X'}}
+
+
+def match_run(detections, released):
+    """External matching decisions of a run by detection and source id, and
+    the source names it gives to its detections.
+
+    """
+    catalogue = released.exclude_run(detections.run_names[0])
+    result = external_match(detections, catalogue, MULTI_RUN_COMPONENTS, source_name_runs(released))
+    names = {i: f'WALLABY {detections.names[i]}' for i in result.accepted}
+    names.update({i: catalogue.source_names[e] for i, e in result.renamed})
+    by_id = (
+        sorted(int(detections.ids[i]) for i in result.accepted),
+        sorted((int(detections.ids[i]), int(catalogue.ids[e])) for i, e in result.renamed),
+        sorted((int(detections.ids[i]), sorted(int(catalogue.ids[e]) for e in exts)) for i, exts in result.deleted),
+        sorted((int(detections.ids[i]), int(catalogue.ids[e])) for i, e in result.conflicts),
+    )
+    return by_id, names
+
+
+def test_multi_run_fold():
+    released, runs = overlapping_runs()
+
+    # One run after another, reloading the released sources each time
+    rows = {int(i): (n, s, r, a, d, f) for i, n, s, r, a, d, f in zip(
+        released.ids, released.names, released.source_names, released.run_names,
+        released.ra, released.dec, released.freq
+    )}
+    sequential = []
+    for detections in runs:
+        state = DetectionSet(sorted(rows), *zip(*[rows[i] for i in sorted(rows)]))
+        decided, names = match_run(detections, state)
+        sequential.append(decided)
+        for i, name in names.items():
+            rows[int(detections.ids[i])] = (
+                detections.names[i], name, detections.run_names[i],
+                detections.ra[i], detections.dec[i], detections.freq[i]
+            )
+
+    # All runs in one pass, folding the new names into the loaded sources
+    together = []
+    for detections in runs:
+        decided, names = match_run(detections, released)
+        together.append(decided)
+        released = released.fold(detections, names, 'WALLABY')
+
+    assert together == sequential
+    # Later runs see the sources named by earlier ones
+    assert any(sequential[2][2])
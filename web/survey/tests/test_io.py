@@ -0,0 +1,53 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from survey.utils.io import tarfile_stream
+
+
+class Chunks(object):
+    """File object with a size that iterates over its chunks, like the large
+    products of ``product_entries``.
+
+    """
+    def __init__(self, chunks, size=None):
+        self.chunks = chunks
+        self.size = sum(len(c) for c in chunks) if size is None else size
+
+    def read(self, n=-1):
+        return b''.join(self.chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+
+def read_tarfile(chunks):
+    with tarfile.open(fileobj=io.BytesIO(b''.join(chunks)), mode='r:gz') as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+
+
+def test_tarfile_stream():
+    entries = [
+        ('a/spec.txt', b'spectrum'),
+        ('a/empty.fits', b''),
+        ('a/cube.fits', os.urandom(256 * 1024)),
+        ('b/cube.fits', os.urandom(256 * 1024)),
+    ]
+    chunks = list(tarfile_stream(entries))
+    # Chunks are yielded as entries are written, not once at the end
+    assert len(chunks) > 2
+    assert read_tarfile(chunks) == dict(entries)
+
+
+def test_tarfile_stream_chunks():
+    blob = [os.urandom(100 * 1024) for _ in range(4)] + [b'end']
+    chunks = list(tarfile_stream([('a/spec.txt', b'spectrum'), ('a/cube.fits', Chunks(blob))]))
+    assert len(chunks) > 2
+    assert read_tarfile(chunks) == {'a/spec.txt': b'spectrum', 'a/cube.fits': b''.join(blob)}
+
+
+def test_tarfile_stream_chunks_size_mismatch():
+    with pytest.raises(OSError):
+        list(tarfile_stream([('a/cube.fits', Chunks([b'abc'], size=4))]))
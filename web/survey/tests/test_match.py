@@ -0,0 +1,71 @@
+import numpy as np
+
+from survey.utils.match import angular_separation, internal_pairs, SkyIndex, match_pairs, match_groups
+
+
+def random_positions(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # Clustered around RA 0 and near a pole to cover RA wraparound and cos(dec)
+    ra = np.concatenate([rng.uniform(-0.05, 0.05, n // 2) % 360.0, rng.uniform(0.0, 360.0, n - n // 2)])
+    dec = np.concatenate([rng.uniform(-30.05, -29.95, n // 2), rng.uniform(89.95, 90.0, n - n // 2)])
+    freq = rng.uniform(1.40e+9, 1.41e+9, n)
+    return ra, dec, freq
+
+
+def test_internal_pairs():
+    ra, dec, freq = random_positions(400)
+    i, j = internal_pairs(ra, dec, freq, thresh_spat=90.0, thresh_spec=2e+6, block_size=64)
+
+    sep = angular_separation(ra[:, None], dec[:, None], ra[None, :], dec[None, :])
+    d_spec = np.abs(freq[:, None] - freq[None, :])
+    expected_i, expected_j = np.nonzero(np.triu((sep < 90.0) & (d_spec < 2e+6), k=1))
+    assert len(expected_i) > 0
+    assert np.array_equal(i, expected_i)
+    assert np.array_equal(j, expected_j)
+
+
+def test_internal_pairs_small():
+    i, j = internal_pairs([10.0], [-30.0], [1.4e+9])
+    assert len(i) == 0 and len(j) == 0
+
+
+def test_sky_index_query():
+    ra, dec, _ = random_positions(300, seed=1)
+    q_ra, q_dec, _ = random_positions(50, seed=2)
+    index = SkyIndex(ra, dec)
+    q, c, sep = index.query(q_ra, q_dec, 120.0, max_candidates=100)
+
+    expected = angular_separation(q_ra[:, None], q_dec[:, None], ra[None, :], dec[None, :])
+    expected_q, expected_c = np.nonzero(expected < 120.0)
+    assert len(expected_q) > 0
+    assert sorted(zip(q.tolist(), c.tolist())) == sorted(zip(expected_q.tolist(), expected_c.tolist()))
+    assert np.allclose(sep, expected[q, c])
+
+
+def test_match_pairs():
+    x = [10.0, 10.0, 10.0, 10.0, 50.0]
+    y = [10.0, 10.0, 11.0, 10.0, 10.0]
+    z = [100.0, 100.0, 100.0, 130.0, 100.0]
+    err = [1.0] * 5
+    i = [0, 0, 0, 0]
+    j = [1, 2, 3, 4]
+    # Same position, within the errors, too far in frequency, too far on the sky
+    assert match_pairs(x, y, z, err, err, err, i, j).tolist() == [True, True, False, False]
+
+
+def test_match_groups():
+    assert match_groups(6, [4, 1, 3], [5, 3, 4]).tolist() == [0, 1, 2, 1, 1, 1]
+    assert match_groups(3, [], []).tolist() == [0, 1, 2]
+
+
+def test_sky_index_nearest():
+    ra, dec, _ = random_positions(300, seed=3)
+    q_ra, q_dec, _ = random_positions(50, seed=4)
+    q, c, sep = SkyIndex(ra, dec).nearest(q_ra, q_dec, 120.0, k=2)
+
+    expected = angular_separation(q_ra[:, None], q_dec[:, None], ra[None, :], dec[None, :])
+    for k in range(len(q_ra)):
+        within = np.nonzero(expected[k] < 120.0)[0]
+        nearest = within[np.argsort(expected[k, within], kind='stable')][:2]
+        assert c[q == k].tolist() == nearest.tolist()
+        assert np.all(np.diff(sep[q == k]) >= 0)
@@ -0,0 +1,123 @@
+import math
+from decimal import Decimal
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from survey.models import Detection, Run
+
+
+SANITY_THRESHOLDS = {'flux': 10, 'spatial_extent': [5, 10], 'spectral_extent': [5, 10], 'uncertainty_sigma': 5}
+
+
+def reference_is_match(a, b, sigma=5):
+    """Per-pair match test of ``is_match`` before the batch version, in
+    floats (the original mixed float and Decimal operands).
+
+    """
+    a, b = (SimpleNamespace(**{f: float(getattr(d, f)) for f in ('x', 'y', 'z', 'err_x', 'err_y', 'err_z')})
+            for d in (a, b))
+    if a.x == b.x and a.y == b.y and a.z == b.z:
+        return True
+    d_space = math.sqrt((a.x - b.x) ** 2 + (a.y - b.y) ** 2)
+    d_space_err = math.sqrt(
+        (a.x - b.x) ** 2 * (a.err_x ** 2 + b.err_x ** 2) +
+        (a.y - b.y) ** 2 * (a.err_y ** 2 + b.err_y ** 2)) / ((a.x - b.x) ** 2 + (a.y - b.y) ** 2)
+    d_spec = abs(a.z - b.z)
+    d_spec_err = math.sqrt(a.err_z ** 2 + b.err_z ** 2)
+    return d_space <= sigma * d_space_err and d_spec <= sigma * d_spec_err
+
+
+def reference_sanity_check(a, b, thresholds=SANITY_THRESHOLDS):
+    """Per-pair sanity check as ``sanity_check`` was before the batch
+    version, returns whether it passed and the first failing property.
+
+    """
+    def diff(f):
+        p, q = getattr(a, f), getattr(b, f)
+        return abs(p - q) * 100 / ((abs(p) + abs(q)) / 2)
+
+    checks = (('f_sum', thresholds['flux']),
+              ('ell_maj', thresholds['spatial_extent'][1]), ('ell_min', thresholds['spatial_extent'][0]),
+              ('w20', thresholds['spectral_extent'][1]), ('w50', thresholds['spectral_extent'][0]))
+    for f, limit in checks:
+        if diff(f) > limit:
+            return False, f
+    return True, None
+
+
+def detection(id, x=100, y=100, z=1000, err=1, f_sum=50, ell_maj=10, ell_min=5, w20=60, w50=40):
+    values = {
+        'x': x, 'y': y, 'z': z, 'err_x': err, 'err_y': err, 'err_z': err,
+        'f_sum': f_sum, 'ell_maj': ell_maj, 'ell_min': ell_min, 'w20': w20, 'w50': w50
+    }
+    run = Run(id=1, name='run', sanity_thresholds=SANITY_THRESHOLDS)
+    return Detection(id=id, run=run, **{k: Decimal(str(v)) for k, v in values.items()})
+
+
+def match_detections():
+    """Detections either side of the match thresholds of the first one. With
+    unit errors and sigma 5, a pair offset along one axis matches spatially
+    up to sqrt(5 sqrt(2)) = 2.659 pixels and spectrally up to 5 sqrt(2) =
+    7.071 channels. No two share a spatial position.
+
+    """
+    variants = [
+        {}, {'x': 102.65}, {'x': 102.67}, {'y': 97.35}, {'y': 97.33},
+        {'x': 101.88, 'y': 101.88}, {'x': 101.9, 'y': 101.9},
+        {'x': 101, 'z': 1007.07}, {'x': 101.01, 'z': 1007.08}, {'x': 101.02, 'z': 992.93}, {'x': 101.03, 'z': 992.92},
+        {'x': 101.5, 'err': 0.5}, {'x': 103, 'err': 2}, {'x': 100.3, 'y': 100.4, 'z': 1003},
+    ]
+    return [detection(k + 1, **v) for k, v in enumerate(variants)]
+
+
+def sanity_detections():
+    """Detections either side of each sanity threshold of the first one.
+
+    """
+    variants = [
+        {}, {'f_sum': 55.2}, {'f_sum': 55.3}, {'ell_maj': 11.0}, {'ell_maj': 11.1},
+        {'ell_min': 5.25}, {'ell_min': 5.26}, {'w20': 66.3}, {'w20': 66.4}, {'w50': 42.0}, {'w50': 42.1},
+        {'f_sum': 60, 'w50': 50},
+    ]
+    return [detection(k + 1, x=100 + k, **v) for k, v in enumerate(variants)]
+
+
+def test_match_matrix_equals_is_match():
+    detections = match_detections()
+    ids, matrix = Detection.match_matrix(detections, sanity_thresholds=SANITY_THRESHOLDS)
+    assert ids.tolist() == [d.id for d in detections]
+    n = len(detections)
+    expected = np.array([[i != j and reference_is_match(a, b) for j, b in enumerate(detections)]
+                         for i, a in enumerate(detections)])
+    assert expected[0].any() and not expected[0, 1:].all()
+    assert np.array_equal(matrix, expected)
+    assert [detections[0].is_match(d) for d in detections[1:]] == expected[0, 1:].tolist()
+    assert matrix.shape == (n, n)
+
+
+def test_sanity_check_pairs_equals_sanity_check():
+    detections = sanity_detections()
+    pairs = [(i, j) for i in range(len(detections)) for j in range(i + 1, len(detections))]
+    verdicts = Detection.sanity_check_pairs(detections, pairs, sanity_thresholds=SANITY_THRESHOLDS)
+    expected = [reference_sanity_check(detections[i], detections[j]) for i, j in pairs]
+    assert {f for _, f in expected} == {None, 'f_sum', 'ell_maj', 'ell_min', 'w20', 'w50'}
+    for (_, _, passed, reason), (expected_passed, field) in zip(verdicts, expected):
+        assert passed == expected_passed
+        assert reason is None if passed else f'Var: {"flux" if field == "f_sum" else field}' in reason
+    base = detections[0]
+    assert [base.sanity_check(d)[0] for d in detections[1:]] == [p for p, _ in expected[:len(detections) - 1]]
+
+
+def test_is_match_same_spatial_position():
+    # The per-pair test divides by the spatial separation
+    with pytest.raises(ValueError):
+        Detection.match_matrix([detection(1), detection(2, z=1001)], sanity_thresholds=SANITY_THRESHOLDS)
+    with pytest.raises(ValueError):
+        detection(1).is_match(detection(2, z=1001))
+    assert detection(1).is_match(detection(2, x=100.5)) is True
+    assert np.array_equal(
+        Detection.match_matrix([detection(1), detection(2)], sanity_thresholds=SANITY_THRESHOLDS)[1],
+        [[False, True], [True, False]]
+    )
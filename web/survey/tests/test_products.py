@@ -0,0 +1,77 @@
+import pytest
+
+from survey.utils import products
+from survey.utils.products import BlobReader
+
+
+class Connection(object):
+    """Connection answering the ``substring`` queries of ``BlobReader`` from
+    a value in memory. ``value`` is read at each query so tests can change
+    it between chunks.
+
+    """
+    def __init__(self, value, compressed=False):
+        self.value = value
+        self.compressed = compressed
+        self.queries = 0
+        self.row = None
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, params):
+        start, n, _ = params
+        self.queries += 1
+        if self.value is None:
+            self.row = None
+        elif self.compressed:
+            self.row = (True, memoryview(self.value))
+        else:
+            self.row = (False, memoryview(self.value[start - 1:start - 1 + n]))
+
+    def fetchone(self):
+        return self.row
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    def patch(value, compressed=False):
+        conn = Connection(value, compressed)
+        monkeypatch.setattr(products, 'connection', conn)
+        return conn
+    return patch
+
+
+def test_blob_reader_chunks(connection):
+    value = bytes(range(256)) * 10
+    conn = connection(value)
+    reader = BlobReader(1, 'cube', len(value), chunk_size=1000)
+    assert reader.read(10) + reader.read() == value
+    assert conn.queries == 3
+    assert b''.join(BlobReader(1, 'cube', len(value), chunk_size=1000)) == value
+
+
+def test_blob_reader_compressed(connection):
+    value = bytes(range(256)) * 10
+    conn = connection(value, compressed=True)
+    reader = BlobReader(1, 'cube', len(value), chunk_size=1000)
+    assert reader.read(10) + reader.read() == value
+    assert conn.queries == 1
+
+
+@pytest.mark.parametrize('value', [b'', None])
+def test_blob_reader_truncated(connection, value):
+    conn = connection(bytes(2000))
+    reader = BlobReader(1, 'cube', 2000, chunk_size=1000)
+    assert len(reader.read(1000)) == 1000
+    conn.value = value
+    with pytest.raises(OSError):
+        reader.read()
+    with pytest.raises(OSError):
+        list(BlobReader(1, 'cube', 2000, chunk_size=1000))
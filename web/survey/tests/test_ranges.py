@@ -0,0 +1,78 @@
+import pytest
+from django.test import RequestFactory
+
+from survey.utils.ranges import parse_range, file_response, MAX_RANGES
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=10-', [(10, 999)]),
+    ('bytes=-100', [(900, 999)]),
+    ('bytes=-2000', [(0, 999)]),
+    ('bytes=990-2000', [(990, 999)]),
+    ('bytes=0-0, 5-9', [(0, 0), (5, 9)]),
+    ('bytes=1000-', []),
+    ('bytes=-0', []),
+    ('bytes=9-5', None),
+    ('bytes=-', None),
+    ('bytes=a-b', None),
+    ('items=0-9', None),
+    ('bytes=' + ','.join(['0-1'] * (MAX_RANGES + 1)), None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.fixture
+def filename(tmp_path):
+    path = tmp_path / 'archive.tar.gz'
+    path.write_bytes(bytes(range(256)) * 4)
+    return str(path)
+
+
+def get(filename, etag=None, **headers):
+    response = file_response(RequestFactory().get('/', **headers), filename, etag=etag)
+    return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+
+def test_file_response(filename):
+    response, content = get(filename)
+    assert response.status_code == 200 and len(content) == 1024
+    assert response['Content-Length'] == '1024'
+
+    response, content = get(filename, HTTP_RANGE='bytes=256-259')
+    assert response.status_code == 206
+    assert response['Content-Range'] == 'bytes 256-259/1024'
+    assert content == bytes([0, 1, 2, 3])
+
+    response, content = get(filename, HTTP_RANGE='bytes=0-1,-1')
+    assert response.status_code == 206
+    assert response['Content-Type'].startswith('multipart/byteranges')
+    assert response['Content-Length'] == str(len(content))
+
+    response, _ = get(filename, HTTP_RANGE='bytes=2000-')
+    assert response.status_code == 416
+    assert response['Content-Range'] == 'bytes */1024'
+
+
+def test_file_response_if_range(filename):
+    response, _ = get(filename)
+    etag, last_modified = response['ETag'], response['Last-Modified']
+    for validator in (etag, last_modified):
+        response, _ = get(filename, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=validator)
+        assert response.status_code == 206
+    response, _ = get(filename, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+    assert response.status_code == 200
+
+
+def test_file_response_etag(filename):
+    response, _ = get(filename, etag='"key"')
+    assert response['ETag'] == '"key"'
+    assert 'Last-Modified' not in response
+
+    response, _ = get(filename, etag='"key"', HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"key"')
+    assert response.status_code == 206
+    # The modification time is not a validator of the content when an ETag is given
+    last_modified = get(filename)[0]['Last-Modified']
+    response, _ = get(filename, etag='"key"', HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=last_modified)
+    assert response.status_code == 200
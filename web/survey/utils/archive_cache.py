@@ -0,0 +1,176 @@
+import os
+import time
+import uuid
+import fcntl
+import hashlib
+import logging
+from django.conf import settings
+from django.db import connection
+
+from survey.models import Product
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+# Seconds to wait for an archive built by another request before streaming it uncached
+LOCK_TIMEOUT = 30.0
+LOCK_POLL = 0.5
+
+
+def cache_enabled():
+    return bool(settings.ARCHIVE_CACHE)
+
+
+def archive_marker(detections):
+    """Checksum of everything an archive of the products of detections depends
+    on: the products and the names of their detections, runs and instances.
+    Products do not change after ingest, so this changes only when detections
+    are added, renamed or deleted. Computed by the database, only the
+    checksum is sent back.
+
+    """
+    rows = Product.objects.filter(detection__in=detections).order_by().values(
+        'id', 'detection_id', 'detection__name', 'detection__run__name', 'detection__instance_id'
+    )
+    sql, params = rows.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT md5(string_agg(t::text, ',' ORDER BY t.id)) FROM ({sql}) t", params)
+        return cursor.fetchone()[0] or ''
+
+
+def archive_key(endpoint, ids, products, marker):
+    key = f'{endpoint}|{",".join(str(i) for i in ids)}|{",".join(products)}|{marker}'
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ArchiveCache(object):
+    """Directory of generated archives named by their key, limited to
+    ``ARCHIVE_CACHE_SIZE`` GiB by removing the least recently used archives.
+
+    An archive is built by one request at a time. Concurrent requests for the
+    same archive wait on a file lock until it is finished and are then
+    served from the cache. Requests that wait longer than ``LOCK_TIMEOUT``
+    stream the archive without the cache.
+
+    """
+    def __init__(self, directory=None, size=None):
+        self.directory = directory or settings.ARCHIVE_CACHE
+        self.size = int((size or settings.ARCHIVE_CACHE_SIZE) * 2**30)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.tar.gz')
+
+    def _hit(self, key):
+        path = self.path(key)
+        try:
+            # The modification time is the last use for eviction
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            return None
+
+    def get(self, key, build, timeout=LOCK_TIMEOUT):
+        """Return ``(path, None)`` if the archive is cached. Otherwise return
+        ``(None, chunks)`` where ``chunks`` streams the archive produced by
+        ``build()`` while writing it to the cache. Waits up to ``timeout``
+        seconds if the archive is being built by another request, then
+        returns ``(None, chunks)`` streaming ``build()`` without the cache.
+
+        """
+        path = self._hit(key)
+        if path is not None:
+            return path, None
+
+        lock = open(os.path.join(self.directory, f'{key}.lock'), 'w')
+        try:
+            if not self._lock(lock, timeout):
+                lock.close()
+                logging.info(f'Archive {key} is still being built, streaming it uncached')
+                return None, build()
+            path = self._hit(key)
+        except Exception:
+            lock.close()
+            raise
+        if path is not None:
+            lock.close()
+            return path, None
+        return None, self._write(key, build(), lock)
+
+    def _lock(self, lock, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(LOCK_POLL)
+
+    def _write(self, key, chunks, lock):
+        tmp = os.path.join(self.directory, f'.{key}.{uuid.uuid4()}.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp, self.path(key))
+            logging.info(f'Cached archive {key}')
+            self.evict(keep=key)
+        finally:
+            # Not cached if the client went away before the end of the archive
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            lock.close()
+
+    def evict(self, keep=None):
+        """Remove the least recently used archives until the cache fits in its
+        size limit, and the lock files of archives that were never finished.
+
+        """
+        archives = []
+        files = os.listdir(self.directory)
+        for f in files:
+            # Lock files are created when a build starts, an old one without
+            # an archive is left by a build that failed or was abandoned
+            key = f[:-len('.lock')]
+            if f.endswith('.lock') and key != keep and f'{key}.tar.gz' not in files:
+                try:
+                    if os.stat(os.path.join(self.directory, f)).st_mtime < time.time() - LOCK_TIMEOUT:
+                        self._remove_lock(key)
+                except FileNotFoundError:
+                    pass
+        for f in files:
+            if not f.endswith('.tar.gz') or f == f'{keep}.tar.gz':
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, f))
+            except FileNotFoundError:
+                continue
+            archives.append((stat.st_mtime, stat.st_size, f))
+        total = sum(a[1] for a in archives)
+        if keep is not None and os.path.exists(self.path(keep)):
+            total += os.path.getsize(self.path(keep))
+        for _, size, f in sorted(archives):
+            if total <= self.size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, f))
+                logging.info(f'Evicted archive {f}')
+            except FileNotFoundError:
+                pass
+            self._remove_lock(f[:-len('.tar.gz')])
+            total -= size
+
+    def _remove_lock(self, key):
+        """Remove the lock file of an archive unless it is being built.
+
+        """
+        try:
+            with open(os.path.join(self.directory, f'{key}.lock'), 'r') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(lock.name)
+        except (FileNotFoundError, BlockingIOError):
+            pass
@@ -0,0 +1,220 @@
+import io
+import csv
+import json
+import time
+import logging
+import tracemalloc
+import numpy as np
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from survey.utils.components import get_release_name
+from survey.utils.released import update_released_sources
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+SANITY_THRESHOLDS = {'flux': 10, 'spatial_extent': [10, 10], 'spectral_extent': [10, 10], 'uncertainty_sigma': 5}
+
+PIXEL_SIZE = 6.0          # arcsec
+CHANNEL_WIDTH = 18.5e+3   # Hz
+FREQ_RANGE = (1.30e+9, 1.42e+9)
+
+DETECTION_COLUMNS = (
+    'instance_id', 'run_id', 'name', 'source_name', 'x', 'y', 'z',
+    'x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max', 'n_pix',
+    'f_min', 'f_max', 'f_sum', 'rel', 'rms', 'w20', 'w50',
+    'ell_maj', 'ell_min', 'ell_pa', 'ell3s_maj', 'ell3s_min', 'ell3s_pa',
+    'ra', 'dec', 'freq', 'err_x', 'err_y', 'err_z', 'err_f_sum', 'unresolved', 'accepted'
+)
+
+
+def detection_name(ra, dec):
+    """SoFiA style name for a position in degrees.
+
+    """
+    h, rem = divmod(ra / 15.0 * 3600.0, 3600.0)
+    m, s = divmod(rem, 60.0)
+    sign = '-' if dec < 0 else '+'
+    d, rem = divmod(abs(dec) * 3600.0, 3600.0)
+    dm, ds = divmod(rem, 60.0)
+    return f'SoFiA_J{int(h):02d}{int(m):02d}{s:05.2f}{sign}{int(d):02d}{int(dm):02d}{ds:04.1f}'
+
+
+class SyntheticSurvey(object):
+    """Synthetic runs, instances, detections and survey components written to
+    the database for benchmarking.
+
+    Runs cover neighbouring strips of sky and are assigned to survey
+    components in turn. All runs except the last are released (accepted and
+    named). ``duplicate_fraction`` of the detections of the last run are
+    boundary duplicates of its own detections, and ``overlap_fraction`` of the
+    detections of every run after the first are repeated detections of sources
+    in the previous run. Repeated detections are offset by about an arcsec and
+    10 kHz, so they are auto matches.
+
+    """
+    def __init__(self, n_detections, n_runs=4, n_components=2, duplicate_fraction=0.05,
+                 overlap_fraction=0.1, density=100.0, seed=0, prefix='benchmark'):
+        self.n_detections = int(n_detections)
+        self.n_runs = int(n_runs)
+        self.n_components = int(n_components)
+        self.duplicate_fraction = float(duplicate_fraction)
+        self.overlap_fraction = float(overlap_fraction)
+        self.density = float(density)
+        self.seed = int(seed)
+        self.prefix = prefix
+        self.run_ids = []
+        self.instance_ids = []
+
+    def parameters(self):
+        return {k: getattr(self, k) for k in (
+            'n_detections', 'n_runs', 'n_components', 'duplicate_fraction',
+            'overlap_fraction', 'density', 'seed'
+        )}
+
+    @property
+    def target_run_id(self):
+        return self.run_ids[-1]
+
+    def _positions(self, rng):
+        """Positions (ra, dec, freq) and run index of all detections, and a
+        flag for the detections that repeat another detection.
+
+        """
+        per_run = self.n_detections // self.n_runs
+        area = self.n_detections / self.density
+        dec0 = -30.0
+        height = np.sqrt(area)
+        width = height / np.cos(np.radians(dec0)) / self.n_runs
+
+        base, repeats = [], []
+        for k in range(self.n_runs):
+            n_dup = int(per_run * self.duplicate_fraction) if k == self.n_runs - 1 else 0
+            n_overlap = int(per_run * self.overlap_fraction) if k > 0 else 0
+            n_base = per_run - n_dup - n_overlap
+            ra = rng.uniform(150.0 + k * width, 150.0 + (k + 1) * width, n_base)
+            dec = rng.uniform(dec0 - height / 2, dec0 + height / 2, n_base)
+            freq = rng.uniform(*FREQ_RANGE, n_base)
+            base.append((ra, dec, freq))
+            repeats.append((n_dup, n_overlap))
+
+        ra_all, dec_all, freq_all, run_all, repeat_all = [], [], [], [], []
+        for k, ((ra, dec, freq), (n_dup, n_overlap)) in enumerate(zip(base, repeats)):
+            ra_all.append(ra)
+            dec_all.append(dec)
+            freq_all.append(freq)
+            run_all.append(np.full(len(ra), k))
+            repeat_all.append(np.zeros(len(ra), dtype=bool))
+            for source, n in ((k, n_dup), (k - 1, n_overlap)):
+                if n == 0:
+                    continue
+                s_ra, s_dec, s_freq = base[source]
+                pick = rng.choice(len(s_ra), n, replace=False)
+                ra_all.append(s_ra[pick] + rng.normal(0, 1.0 / 3600, n) / np.cos(np.radians(s_dec[pick])))
+                dec_all.append(s_dec[pick] + rng.normal(0, 1.0 / 3600, n))
+                freq_all.append(s_freq[pick] + rng.normal(0, 10e+3, n))
+                run_all.append(np.full(n, k))
+                repeat_all.append(np.ones(n, dtype=bool))
+        return (np.concatenate(ra_all), np.concatenate(dec_all), np.concatenate(freq_all),
+                np.concatenate(run_all), np.concatenate(repeat_all))
+
+    def generate(self):
+        """Write the synthetic survey. Returns the number of detections written.
+
+        """
+        rng = np.random.default_rng(self.seed)
+        with connection.cursor() as cursor:
+            run_names = [f'{self.prefix}_{self.seed}_{k}' for k in range(self.n_runs)]
+            for k, run_name in enumerate(run_names):
+                cursor.execute(
+                    'INSERT INTO run (name, sanity_thresholds) VALUES (%s, %s) RETURNING id',
+                    [run_name, json.dumps(SANITY_THRESHOLDS)]
+                )
+                self.run_ids.append(cursor.fetchone()[0])
+                cursor.execute(
+                    "INSERT INTO instance (run_id, filename, boundary, run_date, parameters) "
+                    "VALUES (%s, %s, '{0,0,0,0}', now(), '{}') RETURNING id",
+                    [self.run_ids[-1], f'{run_name}.fits']
+                )
+                self.instance_ids.append(cursor.fetchone()[0])
+            for c in range(self.n_components):
+                runs = [k for k in range(self.n_runs) if k % self.n_components == c]
+                cursor.execute(
+                    'INSERT INTO survey_component (name, runs) VALUES (%s, %s) RETURNING id',
+                    [f'{self.prefix}_{self.seed}_component_{c}', [run_names[k] for k in runs]]
+                )
+                sc_id = cursor.fetchone()[0]
+                for k in runs:
+                    cursor.execute(
+                        'INSERT INTO survey_component_run (run_id, sc_id) VALUES (%s, %s)', [self.run_ids[k], sc_id]
+                    )
+
+            ra, dec, freq, run, _ = self._positions(rng)
+            n = len(ra)
+            released = run < self.n_runs - 1
+            x = (ra - 150.0) * np.cos(np.radians(dec)) * 3600.0 / PIXEL_SIZE
+            y = (dec + 90.0) * 3600.0 / PIXEL_SIZE
+            z = (freq - FREQ_RANGE[0]) / CHANNEL_WIDTH
+            f_sum = rng.lognormal(1.0, 0.5, n)
+            ell_maj = rng.uniform(3.0, 6.0, n)
+            ell_min = ell_maj * rng.uniform(0.5, 1.0, n)
+            w20 = rng.uniform(100.0, 300.0, n)
+
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for i in range(n):
+                name = detection_name(ra[i], dec[i])
+                writer.writerow((
+                    self.instance_ids[run[i]], self.run_ids[run[i]], name,
+                    get_release_name(name) if released[i] else '',
+                    x[i], y[i], z[i],
+                    int(x[i]) - 5, int(x[i]) + 5, int(y[i]) - 5, int(y[i]) + 5, int(z[i]) - 10, int(z[i]) + 10, 400,
+                    -0.01, 0.05, f_sum[i], 0.95, 0.002, w20[i], 0.8 * w20[i],
+                    ell_maj[i], ell_min[i], 45.0, 2 * ell_maj[i], 2 * ell_min[i], 45.0,
+                    ra[i], dec[i], freq[i], 0.2, 0.2, 0.5, 0.1 * f_sum[i], 'f', 't'
+                ))
+            buf.seek(0)
+            cursor.copy_expert(
+                f"COPY detection ({', '.join(DETECTION_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '')", buf
+            )
+            cursor.execute(
+                'SELECT id FROM detection WHERE run_id = ANY(%s) AND source_name IS NOT NULL', [self.run_ids[:-1]]
+            )
+            update_released_sources([r[0] for r in cursor.fetchall()])
+        return n
+
+
+class Benchmark(object):
+    """Collect wall time, number of queries and peak traced memory of stages.
+
+    """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Time the block. Items added to the yielded dict are stored with the
+        stage results.
+
+        """
+        info = {}
+        if self.trace_memory:
+            tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                yield info
+                seconds = time.perf_counter() - start
+        finally:
+            peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+            if self.trace_memory:
+                tracemalloc.stop()
+        result = {'stage': name, 'seconds': round(seconds, 4), 'queries': len(queries),
+                  'peak_memory_mb': None if peak is None else round(peak / 2**20, 2), **info}
+        logging.info(f'Benchmark stage {result}')
+        self.stages.append(result)
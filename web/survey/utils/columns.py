@@ -0,0 +1,45 @@
+import numpy as np
+from array import array
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+
+
+# Rows fetched per round trip of the server side cursor
+CHUNK_SIZE = 10000
+
+
+def read_columns(queryset, columns, chunk_size=CHUNK_SIZE):
+    """Read columns of a queryset through a server side cursor, ``chunk_size``
+    rows at a time, without creating model instances.
+
+    ``columns`` maps field name (lookups allowed) to the column type: ``'i'``
+    for an int64 array, ``'f'`` for a float64 array with NULL as NaN and
+    ``'s'`` for a list of strings. Float columns are read as floats by the
+    database, so no Decimal objects are created. Repeated strings share one
+    object. Returns a dict of field name to column.
+
+    """
+    names = list(columns)
+    fields = [Cast(f, FloatField()) if columns[f] == 'f' else f for f in names]
+    data = [array('q') if columns[f] == 'i' else array('d') if columns[f] == 'f' else [] for f in names]
+    strings = {}
+    nan = float('nan')
+    for row in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        for k, value in enumerate(row):
+            kind = columns[names[k]]
+            if kind == 'f':
+                data[k].append(nan if value is None else value)
+            elif kind == 'i':
+                data[k].append(value)
+            else:
+                data[k].append(strings.setdefault(value, value))
+
+    result = {}
+    for f, d in zip(names, data):
+        if columns[f] == 'i':
+            result[f] = np.frombuffer(d, dtype=np.int64) if len(d) else np.empty(0, dtype=np.int64)
+        elif columns[f] == 'f':
+            result[f] = np.frombuffer(d, dtype=np.float64) if len(d) else np.empty(0, dtype=np.float64)
+        else:
+            result[f] = d
+    return result
@@ -1,13 +1,74 @@
 import re
+import time
+import threading
 from django.conf import settings
-from survey.models import SurveyComponent
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from survey.models import Run, SurveyComponent, SurveyComponentRun
 
 
-def get_survey_components():
-    components_dict = {}
-    for sc in SurveyComponent.objects.all():
-        components_dict[sc.name] = [i.run.name for i in sc.surveycomponentrun_set.all()]
-    return components_dict
+_lock = threading.Lock()
+_index = None
+_loaded = 0.0
+
+# Seconds the index is reused before it is reloaded. Signals only reach the
+# process that made a change, this bounds how stale other workers can be.
+INDEX_TTL = 60
+
+
+class SurveyComponentIndex(object):
+    """Survey component membership of runs, loaded in a single query.
+
+    ``components`` maps survey component name to the list of run names,
+    ``run_components`` maps a run name to the set of survey component names it
+    belongs to and ``run_id_components`` maps a run id to the list of them.
+
+    """
+    def __init__(self, rows):
+        self.components = {}
+        self.run_components = {}
+        self.run_id_components = {}
+        for sc_name, run_id, run_name in rows:
+            runs = self.components.setdefault(sc_name, [])
+            if run_id is None:
+                continue
+            runs.append(run_name)
+            self.run_components.setdefault(run_name, set()).add(sc_name)
+            if sc_name not in self.run_id_components.setdefault(run_id, []):
+                self.run_id_components[run_id].append(sc_name)
+
+    @classmethod
+    def load(cls):
+        return cls(SurveyComponent.objects.order_by('id', 'surveycomponentrun__id').values_list(
+            'name', 'surveycomponentrun__run_id', 'surveycomponentrun__run__name'
+        ))
+
+
+def get_survey_component_index(refresh=False):
+    """Return the survey component index, cached per process for
+    ``INDEX_TTL`` seconds. The cache is dropped whenever survey components,
+    their runs or runs change in this process, use ``refresh`` to force a
+    reload.
+
+    """
+    global _index, _loaded
+    with _lock:
+        if _index is None or refresh or time.monotonic() - _loaded > INDEX_TTL:
+            _index = SurveyComponentIndex.load()
+            _loaded = time.monotonic()
+        return _index
+
+
+@receiver(post_save, sender=SurveyComponent)
+@receiver(post_delete, sender=SurveyComponent)
+@receiver(post_save, sender=SurveyComponentRun)
+@receiver(post_delete, sender=SurveyComponentRun)
+@receiver(post_save, sender=Run)
+@receiver(post_delete, sender=Run)
+def invalidate_survey_component_index(sender, **kwargs):
+    global _index
+    with _lock:
+        _index = None
 
 
 def get_release_name(name):
@@ -42,9 +103,10 @@ def dingo_release_name(name):
 
 
 def get_survey_component(detection):
-    run = detection.run
-    survey_components = get_survey_components()
-    for k, v in survey_components.items():
-        if run.name in v:
-            return k
-    raise Exception("Detection and run not found in survey component list.")
+    survey_components = get_survey_component_index().run_id_components.get(detection.run_id)
+    if not survey_components:
+        # The run may have been added by another process since the index was loaded
+        survey_components = get_survey_component_index(refresh=True).run_id_components.get(detection.run_id)
+    if not survey_components:
+        raise Exception("Detection and run not found in survey component list.")
+    return survey_components[0]
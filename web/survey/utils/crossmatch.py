@@ -0,0 +1,426 @@
+import csv
+import itertools
+import logging
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from survey.utils.match import SkyIndex, THRESH_SPAT, THRESH_SPEC, THRESH_SPAT_AUTO, THRESH_SPEC_AUTO
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class DetectionSet(object):
+    """Columns of a set of detections held as arrays for cross matching.
+
+    """
+    FIELDS = ('id', 'name', 'source_name', 'run__name', 'ra', 'dec', 'freq')
+    RELEASED_FIELDS = ('detection_id', 'detection__name', 'source_name', 'run__name', 'ra', 'dec', 'freq')
+    # Column types of the fields, as used by ``read_columns``
+    COLUMN_TYPES = 'isssfff'
+
+    def __init__(self, ids, names, source_names, run_names, ra, dec, freq):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = list(names)
+        self.source_names = list(source_names)
+        self.run_names = list(run_names)
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self.freq = np.asarray(freq, dtype=np.float64)
+        self._index = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_queryset(cls, queryset, fields=FIELDS):
+        """Read the set from a queryset in chunks through a server side cursor.
+
+        """
+        # Imported here, the module is imported by match worker processes without Django
+        from survey.utils.columns import read_columns
+        columns = read_columns(queryset, dict(zip(fields, cls.COLUMN_TYPES)))
+        return cls(*(columns[f] for f in fields))
+
+    def subset(self, idx):
+        """Return a new set with the detections at the given indices, keeping their order.
+
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        return DetectionSet(
+            self.ids[idx],
+            [self.names[i] for i in idx],
+            [self.source_names[i] for i in idx],
+            [self.run_names[i] for i in idx],
+            self.ra[idx], self.dec[idx], self.freq[idx]
+        )
+
+    @classmethod
+    def concatenate(cls, *sets):
+        return cls(
+            np.concatenate([s.ids for s in sets]),
+            [n for s in sets for n in s.names],
+            [n for s in sets for n in s.source_names],
+            [n for s in sets for n in s.run_names],
+            np.concatenate([s.ra for s in sets]),
+            np.concatenate([s.dec for s in sets]),
+            np.concatenate([s.freq for s in sets])
+        )
+
+    def exclude_run(self, run_name):
+        return self.subset([i for i, r in enumerate(self.run_names) if r != run_name])
+
+    def fold(self, detections, source_names, project):
+        """Return a new catalogue with the given detections added (or replaced,
+        if already present) under their new source names. Only names that are
+        official releases for ``project`` are added.
+
+        """
+        added = [i for i, name in source_names.items() if project in name]
+        new = detections.subset(added)
+        new.source_names = [source_names[i] for i in added]
+        keep = np.nonzero(~np.isin(self.ids, new.ids))[0]
+        return DetectionSet.concatenate(self.subset(keep), new)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = SkyIndex(self.ra, self.dec)
+        return self._index
+
+
+class ExternalMatchResult(object):
+    """Decisions of external cross matching, as indices into the run
+    detections and the released source catalogue.
+
+    """
+    def __init__(self):
+        self.accepted = []   # detection
+        self.renamed = []    # (detection, catalogue source to take name from)
+        self.deleted = []    # (detection, [catalogue sources in same survey component])
+        self.conflicts = []  # (detection, catalogue source)
+        self.separations = {}  # (detection, catalogue source) -> (arcsec, Hz)
+
+
+def same_survey_component(run_components, run_a, run_b):
+    return bool(run_components.get(run_a, set()) & run_components.get(run_b, set()))
+
+
+def source_name_runs(*detection_sets):
+    """Map each source name to the (detection id, run name) of the detections carrying it.
+
+    """
+    name_runs = {}
+    for ds in detection_sets:
+        for i, name, run in zip(ds.ids, ds.source_names, ds.run_names):
+            if name is not None:
+                name_runs.setdefault(name, []).append((i, run))
+    return name_runs
+
+
+def external_match(detections, catalogue, run_components, name_runs=None,
+                   thresh_spat=THRESH_SPAT, thresh_spec=THRESH_SPEC,
+                   thresh_spat_auto=THRESH_SPAT_AUTO, thresh_spec_auto=THRESH_SPEC_AUTO):
+    """Cross match run detections against the released source catalogue.
+
+    All neighbour queries are answered in one batched pass over the catalogue
+    sky index. ``run_components`` maps run name to the set of survey
+    component names the run belongs to. ``name_runs`` maps a source name to
+    the (detection id, run name) of every detection carrying it, and is
+    derived from the catalogue and run detections if not provided.
+
+    """
+    result = ExternalMatchResult()
+    q, c, sep = catalogue.index.query(detections.ra, detections.dec, thresh_spat)
+    d_spec = np.abs(detections.freq[q] - catalogue.freq[c])
+    keep = d_spec < thresh_spec
+    q, c, sep, d_spec = q[keep], c[keep], sep[keep], d_spec[keep]
+    auto = (sep < thresh_spat_auto) & (d_spec < thresh_spec_auto)
+
+    if name_runs is None:
+        name_runs = source_name_runs(detections, catalogue)
+
+    order = np.argsort(q, kind='stable')
+    q, c, sep, d_spec, auto = q[order], c[order], sep[order], d_spec[order], auto[order]
+    bounds = np.searchsorted(q, np.arange(len(detections) + 1))
+
+    n = len(detections)
+    for idx in range(n):
+        name = detections.names[idx]
+        run_name = detections.run_names[idx]
+        delete_detections = []
+        rename_detections = []
+        matches = []
+        for k in range(bounds[idx], bounds[idx + 1]):
+            ext = c[k]
+            result.separations[(idx, ext)] = (float(sep[k]), float(d_spec[k]))
+            if auto[k]:
+                # Logic: delete if in same survey component or reassign to existing source otherwise.
+                if same_survey_component(run_components, run_name, catalogue.run_names[ext]):
+                    delete_detections.append(ext)
+                else:
+                    rename_detections.append(ext)
+            else:
+                matches.append(ext)
+
+        if delete_detections:
+            result.deleted.append((idx, delete_detections))
+            logging.info(
+                f'[{idx+1}/{n}] {name} to be automatically deleted. '
+                f'Conflict: {[catalogue.names[e] for e in delete_detections]}'
+            )
+        elif rename_detections:
+            if len(rename_detections) > 1:
+                logging.error(f'Multiple rename sources: {[catalogue.source_names[e] for e in rename_detections]}')
+                raise Exception(
+                    'Should not be able to rename a detection to more than one source '
+                    '(existing database conflict to resolve).'
+                )
+
+            # Check other detections pointing to rename source in same survey component
+            ext = rename_detections[0]
+            source_name = catalogue.source_names[ext]
+            conflict_in_survey_component = False
+            for other_id, other_run in name_runs.get(source_name, []):
+                if other_id != detections.ids[idx] and same_survey_component(run_components, run_name, other_run):
+                    conflict_in_survey_component = True
+                    logging.info(
+                        f'Cannot rename detection {name} to {source_name} due to potential conflict '
+                        f'{other_id} in same survey component.'
+                    )
+            if conflict_in_survey_component:
+                result.conflicts.append((idx, ext))
+            else:
+                result.renamed.append((idx, ext))
+                logging.info(
+                    f'[{idx+1}/{n}] {name} to be automatically renamed to {source_name} '
+                    f'[{catalogue.run_names[ext]}]'
+                )
+        elif matches:
+            logging.info(
+                f'[{idx+1}/{n}] Matches found for {name}: {[catalogue.names[e] for e in matches]} '
+                f'to resolve manually'
+            )
+            for ext in matches:
+                result.conflicts.append((idx, ext))
+        else:
+            result.accepted.append(idx)
+            logging.info(f'[{idx+1}/{n}] {name} will be accepted')
+
+    return result
+
+
+def _external_match_partition(detections, catalogue, run_components, name_runs, thresholds):
+    return external_match(detections, catalogue, run_components, name_runs, **thresholds)
+
+
+def parallel_external_match(detections, catalogue, run_components, name_runs, processes, **thresholds):
+    """Run ``external_match`` over declination bands of the run detections in
+    separate processes.
+
+    Each band is matched against the catalogue sources within the band plus a
+    halo of the spatial match radius, so every detection sees the same
+    candidates as in the serial case. The decisions are merged back in
+    detection order, which makes the result identical to ``external_match``.
+
+    """
+    thresh_spat = thresholds.get('thresh_spat', THRESH_SPAT)
+    n_bands = max(1, min(processes, len(detections)))
+    if n_bands == 1:
+        return external_match(detections, catalogue, run_components, name_runs, **thresholds)
+    if name_runs is None:
+        name_runs = source_name_runs(catalogue, detections)
+
+    halo = thresh_spat / 3600.0
+    bands = np.array_split(np.argsort(detections.dec, kind='stable'), n_bands)
+    jobs = []
+    for band in bands:
+        band = np.sort(band)
+        lo, hi = np.nanmin(detections.dec[band]), np.nanmax(detections.dec[band])
+        cat_idx = np.nonzero((catalogue.dec >= lo - halo) & (catalogue.dec <= hi + halo))[0]
+        jobs.append((band, cat_idx))
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_bands, mp_context=ctx) as executor:
+        futures = [
+            executor.submit(
+                _external_match_partition,
+                detections.subset(band), catalogue.subset(cat_idx),
+                run_components, name_runs, thresholds
+            ) for band, cat_idx in jobs
+        ]
+        partials = [f.result() for f in futures]
+
+    result = ExternalMatchResult()
+    for (band, cat_idx), partial in zip(jobs, partials):
+        result.accepted += [int(band[i]) for i in partial.accepted]
+        result.renamed += [(int(band[i]), cat_idx[e]) for i, e in partial.renamed]
+        result.deleted += [(int(band[i]), [cat_idx[e] for e in exts]) for i, exts in partial.deleted]
+        result.conflicts += [(int(band[i]), cat_idx[e]) for i, e in partial.conflicts]
+        result.separations.update({(int(band[i]), cat_idx[e]): v for (i, e), v in partial.separations.items()})
+
+    result.accepted.sort()
+    result.renamed.sort(key=lambda r: r[0])
+    result.deleted.sort(key=lambda r: r[0])
+    result.conflicts.sort(key=lambda r: r[0])
+    return result
+
+
+REPORT_FIELDS = ['detection_id', 'name', 'outcome', 'source_name',
+                 'partner_detection_id', 'partner_name', 'partner_source_name', 'partner_run',
+                 'separation_arcsec', 'separation_freq_hz', 'note']
+
+
+def write_report(fh, detections, catalogue, result, release_names, existing_names=(), timings=None):
+    """Write a CSV report of external cross matching decisions to ``fh``.
+
+    ``release_names`` maps detection index to the release name an accepted
+    detection would receive and ``existing_names`` lists the release names
+    that already belong to other sources. Phase timings (seconds) are written
+    as comment lines before the table.
+
+    """
+    for phase, seconds in (timings or {}).items():
+        fh.write(f'# {phase}: {round(seconds, 3)} s\n')
+    writer = csv.writer(fh)
+    writer.writerow(REPORT_FIELDS)
+
+    rows = []
+    for i in result.accepted:
+        note = 'release name already exists' if release_names[i] in existing_names else ''
+        rows.append((i, 'accept', release_names[i], None, note))
+    for i, ext in result.renamed:
+        rows.append((i, 'rename', catalogue.source_names[ext], ext, ''))
+    for i, exts in result.deleted:
+        for ext in exts:
+            rows.append((i, 'delete', None, ext, 'same survey component'))
+    for i, ext in result.conflicts:
+        rows.append((i, 'conflict', None, ext, ''))
+    rows.sort(key=lambda r: r[0])
+
+    for i, outcome, source_name, ext, note in rows:
+        row = [detections.ids[i], detections.names[i], outcome, source_name]
+        if ext is None:
+            row += [None] * 6
+        else:
+            sep, d_spec = result.separations[(i, ext)]
+            row += [catalogue.ids[ext], catalogue.names[ext], catalogue.source_names[ext],
+                    catalogue.run_names[ext], round(sep, 3), round(d_spec, 1)]
+        writer.writerow(row + [note])
+
+
+# Threshold grid around the defaults used for sweeps (arcsec, Hz)
+SWEEP_GRID = {
+    'thresh_spat': [45.0, 60.0, 90.0, 120.0, 180.0],
+    'thresh_spec': [1e+6, 2e+6, 3e+6],
+    'thresh_spat_auto': [2.5, 5.0, 10.0],
+    'thresh_spec_auto': [0.025e+6, 0.05e+6, 0.1e+6],
+}
+
+SWEEP_FIELDS = list(SWEEP_GRID) + ['accepted', 'deleted', 'renamed', 'conflicts', 'multiple_renames']
+
+
+class SeparationCache(object):
+    """Separations of all candidate pairs between run detections and released
+    sources within an outer radius, with the threshold independent parts of
+    the external cross matching decisions. External cross matching outcomes
+    for any thresholds inside the outer radius can be counted from the cache
+    without querying the database again.
+
+    """
+    ARRAYS = ('query', 'source', 'sep', 'd_spec', 'same_component', 'name_conflict')
+
+    def __init__(self, n, radius, max_spec, query, source, sep, d_spec, same_component, name_conflict, run_id=None):
+        self.n = int(n)
+        self.radius = float(radius)
+        self.max_spec = float(max_spec)
+        self.run_id = run_id
+        self.query = np.asarray(query, dtype=np.int64)
+        self.source = np.asarray(source, dtype=np.int64)
+        self.sep = np.asarray(sep, dtype=np.float64)
+        self.d_spec = np.asarray(d_spec, dtype=np.float64)
+        self.same_component = np.asarray(same_component, dtype=bool)
+        self.name_conflict = np.asarray(name_conflict, dtype=bool)
+
+    @classmethod
+    def build(cls, detections, catalogue, run_components, name_runs=None,
+              radius=2 * THRESH_SPAT, max_spec=2 * THRESH_SPEC, run_id=None):
+        if name_runs is None:
+            name_runs = source_name_runs(detections, catalogue)
+        q, c, sep = catalogue.index.query(detections.ra, detections.dec, radius)
+        d_spec = np.abs(detections.freq[q] - catalogue.freq[c])
+        keep = d_spec < max_spec
+        q, c, sep, d_spec = q[keep], c[keep], sep[keep], d_spec[keep]
+
+        same_component = np.zeros(len(q), dtype=bool)
+        name_conflict = np.zeros(len(q), dtype=bool)
+        for k, (a, b) in enumerate(zip(q.tolist(), c.tolist())):
+            run_name = detections.run_names[a]
+            same_component[k] = same_survey_component(run_components, run_name, catalogue.run_names[b])
+            name_conflict[k] = any(
+                other_id != detections.ids[a] and same_survey_component(run_components, run_name, other_run)
+                for other_id, other_run in name_runs.get(catalogue.source_names[b], [])
+            )
+        return cls(len(detections), radius, max_spec, q, c, sep, d_spec, same_component, name_conflict, run_id)
+
+    def save(self, path):
+        np.savez_compressed(
+            path, n=self.n, radius=self.radius, max_spec=self.max_spec,
+            run_id=-1 if self.run_id is None else self.run_id,
+            **{a: getattr(self, a) for a in self.ARRAYS}
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            run_id = int(f['run_id'])
+            return cls(f['n'], f['radius'], f['max_spec'], *[f[a] for a in cls.ARRAYS],
+                       run_id=None if run_id < 0 else run_id)
+
+    def evaluate(self, thresh_spat=THRESH_SPAT, thresh_spec=THRESH_SPEC,
+                 thresh_spat_auto=THRESH_SPAT_AUTO, thresh_spec_auto=THRESH_SPEC_AUTO):
+        """Count the outcomes ``external_match`` would give for the thresholds.
+        Conflicts are counted per pair, as external conflicts are stored.
+
+        """
+        if thresh_spat > self.radius or thresh_spec > self.max_spec:
+            raise ValueError(
+                f'Thresholds ({thresh_spat}, {thresh_spec}) are outside the cached radius '
+                f'({self.radius}, {self.max_spec}).'
+            )
+        keep = (self.sep < thresh_spat) & (self.d_spec < thresh_spec)
+        auto = keep & (self.sep < thresh_spat_auto) & (self.d_spec < thresh_spec_auto)
+
+        deleted = np.bincount(self.query[auto & self.same_component], minlength=self.n) > 0
+        renames = np.bincount(self.query[auto & ~self.same_component], minlength=self.n)
+        blocked = np.bincount(self.query[auto & ~self.same_component & self.name_conflict], minlength=self.n) > 0
+        matches = np.bincount(self.query[keep & ~auto], minlength=self.n)
+
+        single = ~deleted & (renames == 1)
+        manual = ~deleted & (renames == 0)
+        return {
+            'accepted': int(np.sum(manual & (matches == 0))),
+            'deleted': int(np.sum(deleted)),
+            'renamed': int(np.sum(single & ~blocked)),
+            'conflicts': int(np.sum(single & blocked) + np.sum(matches[manual])),
+            'multiple_renames': int(np.sum(~deleted & (renames > 1))),
+        }
+
+    def sweep(self, grid=SWEEP_GRID):
+        """Evaluate every combination of the thresholds in ``grid``, a mapping
+        of ``evaluate`` argument name to a list of values.
+
+        """
+        names = list(grid)
+        rows = []
+        for values in itertools.product(*[grid[k] for k in names]):
+            thresholds = dict(zip(names, values))
+            rows.append({**thresholds, **self.evaluate(**thresholds)})
+        return rows
+
+
+def write_sweep(fh, rows):
+    writer = csv.DictWriter(fh, fieldnames=SWEEP_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
@@ -7,5 +7,84 @@ def tarfile_write(tar, filename, content):
 
     """
     info = tarfile.TarInfo(filename)
+    if hasattr(content, 'read'):
+        # File objects with a size are copied in chunks
+        info.size = content.size
+        tar.addfile(info, content)
+        return
     info.size = len(content)
     tar.addfile(info, io.BytesIO(initial_bytes=content))
+
+
+class StreamBuffer(object):
+    """Write only file object that holds what was written until it is taken
+    with ``pop``. Used to stream a tarfile as it is written.
+
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def tarfile_write_chunks(tar, filename, content):
+    """Write a file object with a size that iterates over its chunks to a
+    tarfile, as ``TarFile.addfile`` does. Yields after each chunk is written.
+
+    """
+    info = tarfile.TarInfo(filename)
+    info.size = content.size
+    header = info.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(header)
+    tar.offset += len(header)
+    written = 0
+    for chunk in content:
+        tar.fileobj.write(chunk)
+        written += len(chunk)
+        yield
+    if written != info.size:
+        raise OSError(f'{filename} is {written} bytes, expected {info.size}.')
+    blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tar.offset += blocks * tarfile.BLOCKSIZE
+    tar.members.append(info)
+
+
+def tarfile_stream(entries):
+    """Generator of the chunks of a gzip compressed tarfile of ``(filename,
+    content)`` entries. Each entry is compressed and yielded as soon as it is
+    read, file objects are yielded chunk by chunk, so memory use does not
+    depend on the size of the entries.
+
+    """
+    fh = StreamBuffer()
+    with tarfile.open(fileobj=fh, mode='w|gz') as tar:
+        for filename, content in entries:
+            if hasattr(content, 'read'):
+                for _ in tarfile_write_chunks(tar, filename, content):
+                    data = fh.pop()
+                    if data:
+                        yield data
+            else:
+                tarfile_write(tar, filename, content)
+            data = fh.pop()
+            if data:
+                yield data
+    yield fh.pop()
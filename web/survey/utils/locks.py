@@ -0,0 +1,66 @@
+import logging
+from contextlib import contextmanager
+from django.db import connection
+
+from survey.models import SurveyComponentRun
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+# Advisory lock key namespaces, the object id is stored in the low 48 bits
+RUN_LOCK = 1
+SURVEY_COMPONENT_LOCK = 2
+RELEASE_NAME_LOCK = 3
+
+
+def _lock_key(namespace, obj_id):
+    return (namespace << 48) | int(obj_id)
+
+
+@contextmanager
+def curation_lock(runs, survey_components=False):
+    """Hold PostgreSQL advisory locks on runs for the duration of the block,
+    and on the survey components of the runs if ``survey_components`` is set.
+
+    Locks are taken without waiting, so an operation that conflicts with one
+    already in progress is rejected with an exception. Session level locks
+    are used so they can span several transactions, they are released when
+    the block exits.
+
+    """
+    labels = {_lock_key(RUN_LOCK, r.id): f'Run {r.name}' for r in runs}
+    if survey_components:
+        components = SurveyComponentRun.objects.filter(run__in=[r.id for r in runs])
+        for sc_id, sc_name in components.values_list('sc_id', 'sc__name'):
+            labels[_lock_key(SURVEY_COMPONENT_LOCK, sc_id)] = f'Survey component {sc_name}'
+
+    acquired = []
+    try:
+        with connection.cursor() as cursor:
+            # Always lock in the same order
+            for key in sorted(labels):
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', [key])
+                if not cursor.fetchone()[0]:
+                    raise Exception(
+                        f'{labels[key]} is locked by another curation task, try again once it has finished.'
+                    )
+                acquired.append(key)
+        logging.info(f'Acquired curation locks: {[labels[k] for k in acquired]}')
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            for key in reversed(acquired):
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [key])
+
+
+def lock_release_names():
+    """Take the advisory lock on release names for the rest of the current
+    transaction. Runs in different survey components can overlap on the sky,
+    so checking a release name is free and writing it is serialised across
+    all runs. Waits for the transaction holding it, which only spans a name
+    check and its write-back, and is released when the transaction ends.
+
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [_lock_key(RELEASE_NAME_LOCK, 0)])
@@ -0,0 +1,188 @@
+import numpy as np
+
+
+ARCSEC_PER_RAD = 3600.0 * 180.0 / np.pi
+
+# Default cross matching thresholds (arcsec, Hz)
+THRESH_SPAT = 90.0
+THRESH_SPEC = 2e+6
+THRESH_SPAT_AUTO = 5.0
+THRESH_SPEC_AUTO = 0.05e+6
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Angular separation (arcsec) between positions given in degrees.
+
+    Inputs are broadcast against each other. Uses the same spherical law of
+    cosines as the original per-pair check so that pairs close to a threshold
+    are classified identically.
+
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (ra1, dec1, ra2, dec2))
+    cos_sep = np.sin(dec1) * np.sin(dec2) + np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2)
+    return ARCSEC_PER_RAD * np.arccos(np.clip(cos_sep, -1.0, 1.0))
+
+
+def internal_pairs(ra, dec, freq, thresh_spat=THRESH_SPAT, thresh_spec=THRESH_SPEC, block_size=2048):
+    """Find all pairs of positions within the spatial and spectral thresholds.
+
+    Positions are sorted by declination so that each block of rows only has to
+    be compared against the rows within ``thresh_spat`` in declination. Work is
+    done in ``block_size`` x ``block_size`` tiles to bound memory.
+
+    Returns two integer arrays ``(i, j)`` of indices into the input arrays,
+    with ``i < j``, sorted lexicographically.
+
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    freq = np.asarray(freq, dtype=np.float64)
+    n = len(ra)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    order = np.argsort(dec, kind='stable')
+    ra_s, dec_s, freq_s = ra[order], dec[order], freq[order]
+    radius = thresh_spat / 3600.0
+
+    rows, cols = [], []
+    for r0 in range(0, n, block_size):
+        r1 = min(r0 + block_size, n)
+        c_end = np.searchsorted(dec_s, dec_s[r1 - 1] + radius, side='right')
+        for c0 in range(r0, c_end, block_size):
+            c1 = min(c0 + block_size, c_end)
+            sep = angular_separation(ra_s[r0:r1, None], dec_s[r0:r1, None], ra_s[None, c0:c1], dec_s[None, c0:c1])
+            d_spec = np.abs(freq_s[r0:r1, None] - freq_s[None, c0:c1])
+            r, c = np.nonzero((sep < thresh_spat) & (d_spec < thresh_spec))
+            r += r0
+            c += c0
+            upper = c > r
+            rows.append(r[upper])
+            cols.append(c[upper])
+
+    a = order[np.concatenate(rows)]
+    b = order[np.concatenate(cols)]
+    i, j = np.minimum(a, b), np.maximum(a, b)
+    idx = np.lexsort((j, i))
+    return i[idx], j[idx]
+
+
+class SkyIndex(object):
+    """Declination sorted index of sky positions for batched cone searches.
+
+    Candidates for each query are taken from the declination band of the
+    search radius and then tested on the true angular separation, so RA
+    wraparound and the cos(dec) compression towards the poles are handled.
+
+    """
+    def __init__(self, ra, dec):
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        self.order = np.argsort(dec, kind='stable')
+        self.ra = ra[self.order]
+        self.dec = dec[self.order]
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, ra, dec, radius, max_candidates=2**22):
+        """Find all indexed positions within ``radius`` (arcsec) of each query.
+
+        Returns ``(query_idx, index_idx, separation)`` arrays, where
+        ``index_idx`` refers to the positions the index was built from.
+        Queries are processed in chunks of at most ``max_candidates``
+        candidate pairs to bound memory.
+
+        """
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        if len(ra) == 0 or len(self) == 0:
+            return empty
+
+        radius_deg = radius / 3600.0
+        lo = np.searchsorted(self.dec, dec - radius_deg, side='left')
+        hi = np.searchsorted(self.dec, dec + radius_deg, side='right')
+        counts = hi - lo
+        ends = np.cumsum(counts)
+
+        q_out, c_out, s_out = [], [], []
+        q0 = 0
+        while q0 < len(ra):
+            base = ends[q0] - counts[q0]
+            q1 = max(int(np.searchsorted(ends, base + max_candidates, side='right')), q0 + 1)
+            n = counts[q0:q1]
+            total = int(n.sum())
+            if total > 0:
+                q = np.repeat(np.arange(q0, q1), n)
+                c = np.repeat(lo[q0:q1], n) + np.arange(total) - np.repeat(np.cumsum(n) - n, n)
+                sep = angular_separation(ra[q], dec[q], self.ra[c], self.dec[c])
+                keep = sep < radius
+                q_out.append(q[keep])
+                c_out.append(self.order[c[keep]])
+                s_out.append(sep[keep])
+            q0 = q1
+
+        if not q_out:
+            return empty
+        return np.concatenate(q_out), np.concatenate(c_out), np.concatenate(s_out)
+
+    def nearest(self, ra, dec, radius, k=1, max_candidates=2**22):
+        """Find up to ``k`` nearest indexed positions within ``radius``
+        (arcsec) of each query. Returns the same arrays as ``query``, ordered
+        by query and then separation.
+
+        """
+        q, c, sep = self.query(ra, dec, radius, max_candidates)
+        order = np.lexsort((c, sep, q))
+        q, c, sep = q[order], c[order], sep[order]
+        starts = np.searchsorted(q, q, side='left')
+        keep = np.arange(len(q)) - starts < k
+        return q[keep], c[keep], sep[keep]
+
+
+def match_pairs(x, y, z, err_x, err_y, err_z, i, j, sigma=5):
+    """Vectorised form of ``Detection.is_match`` for the pairs ``(i[k], j[k])``
+    of detections from the same run, given their pixel positions and
+    uncertainties. Returns a boolean array.
+
+    Detections at the same position always match. Pairs at the same spatial
+    but different spectral position only need to pass the spectral test.
+
+    """
+    x, y, z, err_x, err_y, err_z = (np.asarray(a, dtype=np.float64) for a in (x, y, z, err_x, err_y, err_z))
+    i = np.asarray(i, dtype=np.int64)
+    j = np.asarray(j, dtype=np.int64)
+    dx2 = (x[i] - x[j]) ** 2
+    dy2 = (y[i] - y[j]) ** 2
+    d_space2 = dx2 + dy2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_space_err = np.sqrt(dx2 * (err_x[i] ** 2 + err_x[j] ** 2) + dy2 * (err_y[i] ** 2 + err_y[j] ** 2)) / d_space2
+        spatial = (d_space2 == 0) | (np.sqrt(d_space2) <= sigma * d_space_err)
+    d_spec = np.abs(z[i] - z[j])
+    spectral = d_spec <= sigma * np.sqrt(err_z[i] ** 2 + err_z[j] ** 2)
+    same = (d_space2 == 0) & (d_spec == 0)
+    return same | (spatial & spectral)
+
+
+def match_groups(n, i, j):
+    """Group ``n`` items connected by the pairs ``(i[k], j[k])`` with a
+    union-find. Returns an array of group labels, where the label of a group
+    is the smallest index in it.
+
+    """
+    parent = np.arange(n)
+
+    def find(a):
+        root = a
+        while parent[root] != root:
+            root = parent[root]
+        while parent[a] != root:
+            parent[a], a = root, parent[a]
+        return root
+
+    for a, b in zip(i, j):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    return np.array([find(a) for a in range(n)], dtype=np.int64)
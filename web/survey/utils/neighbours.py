@@ -0,0 +1,137 @@
+import logging
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+
+from survey.models import Detection, DetectionNeighbour, DetectionNeighbourRun
+from survey.utils.match import angular_separation, internal_pairs, THRESH_SPAT, THRESH_SPEC
+from survey.utils.columns import read_columns
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+# Candidates are selected with a margin on the pg_sphere circle, the radius
+# is applied to the separation computed like ``internal_pairs``
+CANDIDATE_MARGIN = 1.0
+
+CANDIDATE_SQL = (
+    'SELECT d.id, n.id, d.run_id, n.run_id, d.ra, d."dec", d.freq, n.ra, n."dec", n.freq '
+    'FROM detection d JOIN detection n ON n.pos <@ scircle(d.pos, radians(%s / 3600.0)) AND n.id <> d.id '
+    'WHERE d.id = ANY(%s)'
+)
+
+
+def build_neighbours(run, radius=None, batch_size=5000):
+    """Compute the neighbours of all detections of a run within ``radius``
+    (arcsec), in both directions so the neighbour lists of detections in
+    other runs stay complete. Candidates are found in batches of detections
+    using the spatial index. Separations are computed with
+    ``angular_separation`` from the same columns as ``internal_pairs``, so
+    both paths classify pairs near a threshold identically. Rows are removed
+    with their detections or runs by the foreign key cascades.
+
+    """
+    if radius is None:
+        radius = settings.NEIGHBOUR_RADIUS
+    ids = list(Detection.objects.filter(run=run).order_by('id').values_list('id', flat=True))
+    count = 0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM detection_neighbour WHERE detection_id IN (SELECT id FROM detection WHERE run_id = %s) '
+            'OR neighbour_run_id = %s', [run.id, run.id]
+        )
+        for i in range(0, len(ids), batch_size):
+            cursor.execute(CANDIDATE_SQL, [float(radius) + CANDIDATE_MARGIN, ids[i:i + batch_size]])
+            rows = cursor.fetchall()
+            if not rows:
+                continue
+            d_id, n_id, d_run, n_run = (np.array(c, dtype=np.int64) for c in list(zip(*rows))[:4])
+            ra1, dec1, freq1, ra2, dec2, freq2 = (
+                np.array([np.nan if v is None else v for v in c], dtype=np.float64) for c in list(zip(*rows))[4:]
+            )
+            sep = angular_separation(ra1, dec1, ra2, dec2)
+            d_freq = np.abs(freq1 - freq2)
+            neighbours = {}
+            for k in np.nonzero(sep <= radius)[0].tolist():
+                f = None if np.isnan(d_freq[k]) else float(d_freq[k])
+                neighbours[(d_id[k], n_id[k])] = (n_run[k], sep[k], f)
+                neighbours[(n_id[k], d_id[k])] = (d_run[k], sep[k], f)
+            DetectionNeighbour.objects.bulk_create([
+                DetectionNeighbour(
+                    detection_id=int(a), neighbour_id=int(b), neighbour_run_id=int(r), sep=float(s), d_freq=f
+                ) for (a, b), (r, s, f) in neighbours.items()
+            ], batch_size=batch_size, ignore_conflicts=True)
+            count += len(neighbours)
+        # Detections added later have larger ids, the table is incomplete after that
+        cursor.execute(
+            'INSERT INTO detection_neighbour_run (run_id, radius, max_detection_id) VALUES (%s, %s, %s) '
+            'ON CONFLICT (run_id) DO UPDATE SET radius = EXCLUDED.radius, '
+            'max_detection_id = EXCLUDED.max_detection_id, created = now()',
+            [run.id, float(radius), ids[-1] if ids else 0]
+        )
+    logging.info(
+        f'Detection neighbours of {len(ids)} detections in run {run.name} within {radius} arcsec: {count} rows'
+    )
+    return count
+
+
+def neighbours_built(runs, radius):
+    """True if neighbours were built for all runs with an outer radius of at
+    least ``radius`` and no detections were added to the runs since. Pairs
+    between two runs are complete up to the smaller of their radii.
+
+    """
+    run_ids = {r.id for r in runs}
+    built = DetectionNeighbourRun.objects.filter(run_id__in=run_ids).values_list('run_id', 'radius', 'max_detection_id')
+    if len(built) != len(run_ids) or min(r[1] for r in built) < radius:
+        return False
+    added = Q()
+    for run_id, _, max_detection_id in built:
+        added |= Q(run_id=run_id, id__gt=max_detection_id or 0)
+    if Detection.objects.filter(added).exists():
+        logging.info(f'Detections were added to runs {sorted(run_ids)} after their neighbours were built')
+        return False
+    return True
+
+
+def internal_neighbour_pairs(run, thresh_spat, thresh_spec, **filters):
+    """Pairs of detection ids ``(i, j)`` with ``i < j`` in a run within the
+    spatial and spectral thresholds, read from the neighbour table. Filters
+    are applied to both detections of a pair. Returns None if the neighbours
+    of the run were not built with a large enough radius.
+
+    """
+    if not neighbours_built([run], thresh_spat):
+        return None
+    pairs = DetectionNeighbour.objects.filter(
+        detection__run=run, neighbour_run=run,
+        detection_id__lt=F('neighbour_id'),
+        sep__lt=thresh_spat, d_freq__lt=thresh_spec,
+        **{f'detection__{k}': v for k, v in filters.items()},
+        **{f'neighbour__{k}': v for k, v in filters.items()},
+    ).order_by('detection_id', 'neighbour_id')
+    pairs = read_columns(pairs, {'detection_id': 'i', 'neighbour_id': 'i'})
+    return pairs['detection_id'], pairs['neighbour_id']
+
+
+def run_pairs(run, ids, ra, dec, freq, thresh_spat=THRESH_SPAT, thresh_spec=THRESH_SPEC, **filters):
+    """Index pairs ``(i, j)`` into ``ids`` of detections of a run within the
+    thresholds, as returned by ``internal_pairs``. Read from the neighbour
+    table when it was built for the run and computed from the positions
+    otherwise. ``filters`` should select the detections in ``ids``.
+
+    """
+    pairs = internal_neighbour_pairs(run, thresh_spat, thresh_spec, **filters)
+    if pairs is None:
+        return internal_pairs(ra, dec, freq, thresh_spat, thresh_spec)
+
+    ids = np.asarray(ids, dtype=np.int64)
+    keep = np.isin(pairs[0], ids) & np.isin(pairs[1], ids)
+    order = np.argsort(ids)
+    a = order[np.searchsorted(ids, pairs[0][keep], sorter=order)]
+    b = order[np.searchsorted(ids, pairs[1][keep], sorter=order)]
+    i, j = np.minimum(a, b), np.maximum(a, b)
+    idx = np.lexsort((j, i))
+    return i[idx], j[idx]
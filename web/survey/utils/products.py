@@ -0,0 +1,154 @@
+from urllib.request import pathname2url
+from django.db import connection
+from django.db.models import F, Func, Case, When, IntegerField, BinaryField
+
+from survey.models import Product
+from survey.utils.plot import product_summary_image
+from survey.utils.store import store_enabled
+
+
+# Products written to archives, in order
+ARCHIVE_PRODUCTS = ('mom0', 'mom1', 'mom2', 'cube', 'mask', 'chan', 'spec')
+
+# Product columns that can be read in chunks
+BLOB_FIELDS = ('cube', 'mask', 'mom0', 'mom1', 'mom2', 'chan', 'snr', 'spec', 'pv', 'plot')
+
+# Products fetched per round trip of the server side cursor, products can be large
+PRODUCT_BATCH_SIZE = 50
+
+# Blobs up to this size are read with the product row, larger ones in chunks
+INLINE_SIZE = 64 * 1024
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+
+class BlobReader(object):
+    """File object reading a product column from the database in chunks with
+    ``substring``, so at most one chunk of the blob is held in memory. Values
+    stored compressed are read in a single fetch, as every ``substring`` of
+    them decompresses the whole value.
+
+    """
+    def __init__(self, product_id, field, size, chunk_size=BLOB_CHUNK_SIZE):
+        if field not in BLOB_FIELDS:
+            raise ValueError(f'{field} is not a product column.')
+        self.product_id = product_id
+        self.field = field
+        self.size = size
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.buffer = b''
+        self.position = 0
+
+    def _fetch(self):
+        n = min(self.chunk_size, self.size - self.offset)
+        with connection.cursor() as cursor:
+            # substring of bytea is 1 based
+            cursor.execute(
+                f'SELECT pg_column_compression({self.field}) IS NOT NULL, '
+                f'CASE WHEN pg_column_compression({self.field}) IS NULL '
+                f'THEN substring({self.field} from %s for %s) ELSE {self.field} END FROM product WHERE id = %s',
+                [self.offset + 1, n, self.product_id]
+            )
+            row = cursor.fetchone()
+        compressed, value = row if row is not None else (False, None)
+        chunk = b'' if value is None else bytes(value)
+        if compressed:
+            chunk = chunk[self.offset:self.size]
+        if not chunk:
+            # The product was changed or deleted while it was being read
+            raise OSError(f'Product {self.product_id} {self.field} ended at {self.offset} of {self.size} bytes.')
+        self.offset += len(chunk)
+        return chunk
+
+    def read(self, n=-1):
+        if n < 0:
+            n = self.size
+        parts = []
+        while n > 0:
+            if self.position == len(self.buffer):
+                if self.offset >= self.size:
+                    break
+                self.buffer, self.position = self._fetch(), 0
+            part = self.buffer[self.position:self.position + n]
+            self.position += len(part)
+            n -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+    def __iter__(self):
+        while self.offset < self.size:
+            yield self._fetch()
+
+
+def iter_products(detections, fields=(), blobs=(), batch_size=PRODUCT_BATCH_SIZE):
+    """Iterate over the products of a queryset or list of detections (or
+    detection ids) with the detection, run name and instance id, in detection
+    order. ``fields`` are read in full. Only the size of the ``blobs`` columns
+    is read, with their content if small. Rows are read in batches through a
+    server side cursor. Detections without products are skipped.
+
+    """
+    annotations = {}
+    for f in blobs:
+        size = Func(F(f), function='octet_length', output_field=IntegerField())
+        annotations[f'{f}_size'] = size
+        annotations[f'{f}_inline'] = Case(
+            When(**{f'{f}_size__lte': INLINE_SIZE}, then=F(f)), default=None, output_field=BinaryField()
+        )
+    products = Product.objects.filter(detection__in=detections)\
+        .select_related('detection', 'detection__run', 'detection__instance')\
+        .only('detection__name', 'detection__run__name', 'detection__instance__id', *fields)\
+        .annotate(**annotations)\
+        .order_by('detection__x', 'detection_id')
+    if blobs and store_enabled():
+        products = products.prefetch_related('productfile_set')
+    return products.iterator(chunk_size=batch_size)
+
+
+def product_blob(product, field):
+    """Content of a product column annotated by ``iter_products``: bytes if
+    small, a ``BlobReader`` with the size if large, a ``FileBlob`` if moved to
+    the product store and None if NULL.
+
+    """
+    size = getattr(product, f'{field}_size')
+    if size is None:
+        if store_enabled():
+            for f in product.productfile_set.all():
+                if f.name == field:
+                    return f.open()
+        return None
+    inline = getattr(product, f'{field}_inline')
+    if inline is not None:
+        return bytes(inline)
+    return BlobReader(product.id, field, size)
+
+
+def product_filename(detection):
+    """File name prefix of the products of a detection.
+
+    """
+    name = f"{detection.run.name}_{detection.instance.id}_{detection.name}"
+    return pathname2url(name.replace(' ', '_'))
+
+
+def product_entries(detections, products=ARCHIVE_PRODUCTS, folder='detection', summary=False,
+                    batch_size=PRODUCT_BATCH_SIZE):
+    """Tarfile entries ``(filename, content)`` of the products of detections,
+    large products are read in chunks. Files are put in a folder named after
+    the detection or the run (``folder``), or at the top level if None. A
+    summary image is added for each detection if ``summary`` is set.
+
+    """
+    fields = ['plot'] if summary else []
+    for product in iter_products(detections, fields, products, batch_size):
+        detection = product.detection
+        name = product_filename(detection)
+        if folder is not None:
+            directory = (detection.name if folder == 'detection' else detection.run.name).replace(' ', '_')
+            name = f'{directory}/{name}'
+        for p in products:
+            ext = 'txt' if p == 'spec' else 'png' if p == 'plot' else 'fits'
+            yield f'{name}_{p}.{ext}', product_blob(product, p)
+        if summary:
+            yield f'{name}_summary.png', product_summary_image(product, size=(8, 6), binary_image=True)
@@ -0,0 +1,133 @@
+import os
+import re
+import uuid
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date
+
+
+# Requests for more ranges than this are answered with the whole file
+MAX_RANGES = 64
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def read_in_chunks(filename, start=0, length=None, chunk_size=1024*64):
+    """Read ``length`` bytes of a file from ``start`` (to the end of the file
+    if None) in chunks.
+
+    """
+    with open(filename, 'rb') as infile:
+        infile.seek(start)
+        while length is None or length > 0:
+            chunk = infile.read(chunk_size if length is None else min(chunk_size, length))
+            if not chunk:
+                # We're at the end of the file
+                return
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+
+def parse_range(header, size):
+    """Parse a ``Range`` header into a list of ``(start, end)`` byte ranges,
+    ``end`` inclusive. Returns None if the header is invalid or should be
+    ignored and an empty list if no range can be satisfied.
+
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        match = RANGE_RE.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            # Suffix range, the last bytes of the file
+            n = int(last)
+            if n == 0 or size == 0:
+                continue
+            ranges.append((max(size - n, 0), size - 1))
+            continue
+        first = int(first)
+        if last != '' and int(last) < first:
+            return None
+        last = size - 1 if last == '' else min(int(last), size - 1)
+        if first < size:
+            ranges.append((first, last))
+    return ranges
+
+
+def file_etag(stat):
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def file_response(request, filename, content_type='application/octet-stream', disposition=None, etag=None):
+    """Response streaming a file with support for ``Range`` requests. Single
+    ranges are sent as a 206 response, multiple ranges as a
+    ``multipart/byteranges`` 206 response. A ``Range`` is ignored if an
+    ``If-Range`` validator does not match the file. The ETag is derived from
+    the size and modification time of the file unless given. A given ETag is
+    the only validator, ``Last-Modified`` is not sent as the modification time
+    may change without the content changing.
+
+    """
+    stat = os.stat(filename)
+    size = stat.st_size
+    last_modified = None if etag else http_date(stat.st_mtime)
+    etag = etag or file_etag(stat)
+
+    ranges = None
+    header = request.META.get('HTTP_RANGE')
+    if header and request.method in ('GET', 'HEAD'):
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range.strip() in (etag, last_modified):
+            ranges = parse_range(header, size)
+
+    if ranges is None:
+        response = StreamingHttpResponse(streaming_content=read_in_chunks(filename), content_type=content_type)
+        response['Content-Length'] = size
+    elif not ranges:
+        response = HttpResponse('Requested range not satisfiable.', status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            streaming_content=read_in_chunks(filename, start, end - start + 1),
+            content_type=content_type, status=206
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    else:
+        boundary = uuid.uuid4().hex
+        headers = [
+            f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode()
+            for start, end in ranges
+        ]
+        closing = f'\r\n--{boundary}--\r\n'.encode()
+
+        def parts():
+            for part, (start, end) in zip(headers, ranges):
+                yield part
+                yield from read_in_chunks(filename, start, end - start + 1)
+            yield closing
+
+        response = StreamingHttpResponse(
+            streaming_content=parts(),
+            content_type=f'multipart/byteranges; boundary={boundary}', status=206
+        )
+        length = sum(len(h) for h in headers) + len(closing) + sum(end - start + 1 for start, end in ranges)
+        response['Content-Length'] = length
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = last_modified
+    if disposition is not None and response.status_code != 416:
+        response['Content-Disposition'] = disposition
+    return response
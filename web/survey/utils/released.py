@@ -0,0 +1,86 @@
+import logging
+from django.db import connection
+
+from survey.models import ReleasedSource
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+def update_released_sources(detection_ids):
+    """Synchronise the released source index with the detection table for
+    the given detections. Call after changing the source name or accepted
+    flag of detections.
+
+    """
+    ids = [int(i) for i in detection_ids]
+    if not ids:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM released_source WHERE detection_id = ANY(%s)', [ids])
+        cursor.execute(
+            'INSERT INTO released_source (detection_id, run_id, source_name, ra, "dec", freq) '
+            'SELECT id, run_id, source_name, ra, "dec", freq FROM detection '
+            'WHERE id = ANY(%s) AND accepted AND source_name IS NOT NULL',
+            [ids]
+        )
+
+
+def rebuild_released_sources():
+    """Rebuild the released source index from the detection table.
+
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM released_source')
+        cursor.execute(
+            'INSERT INTO released_source (detection_id, run_id, source_name, ra, "dec", freq) '
+            'SELECT id, run_id, source_name, ra, "dec", freq FROM detection '
+            'WHERE accepted AND source_name IS NOT NULL'
+        )
+        count = cursor.rowcount
+    logging.info(f'Released source index rebuilt with {count} sources')
+    return count
+
+
+def check_released_sources():
+    """Raise if the released source index does not hold every accepted and
+    named detection, so cross matching never runs against a missing or stale
+    index.
+
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT (SELECT count(*) FROM detection WHERE accepted AND source_name IS NOT NULL), '
+            '(SELECT count(*) FROM released_source)'
+        )
+        released, indexed = cursor.fetchone()
+    if released != indexed:
+        raise Exception(
+            f'Released source index holds {indexed} sources but {released} detections are released. '
+            f'Run "python manage.py rebuild_released_sources" before cross matching.'
+        )
+
+
+def released_name_runs(source_names):
+    """Map each of the source names to the (detection id, run name) of the
+    released sources carrying it.
+
+    """
+    return release_name_collisions(source_names)
+
+
+def release_name_collisions(names, exclude_run=None, exclude_ids=()):
+    """Map each of the proposed release names that is already taken by a
+    released source to the (detection id, run name) of the sources holding
+    it. One query on the indexed source names for the whole batch.
+
+    """
+    released = ReleasedSource.objects.filter(source_name__in=set(names))
+    if exclude_run is not None:
+        released = released.exclude(run=exclude_run)
+    if exclude_ids:
+        released = released.exclude(detection_id__in=list(exclude_ids))
+    collisions = {}
+    for d_id, source_name, run_name in released.values_list('detection_id', 'source_name', 'run__name'):
+        collisions.setdefault(source_name, []).append((d_id, run_name))
+    return collisions
@@ -0,0 +1,93 @@
+import os
+import uuid
+import hashlib
+from django.conf import settings
+
+
+# Bytes read from files per chunk
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+def store_enabled():
+    return bool(settings.PRODUCT_STORE)
+
+
+def store_relative_path(checksum):
+    """Path of a blob relative to the store root, blobs are spread over two
+    levels of directories by the first bytes of their checksum.
+
+    """
+    return os.path.join(checksum[:2], checksum[2:4], checksum)
+
+
+def store_path(checksum):
+    return os.path.join(settings.PRODUCT_STORE, store_relative_path(checksum))
+
+
+def store_url(checksum):
+    """Internal nginx location of a blob, for X-Accel-Redirect.
+
+    """
+    return settings.PRODUCT_STORE_URL.rstrip('/') + '/' + store_relative_path(checksum)
+
+
+def write_blob(chunks):
+    """Write the chunks of a blob to the store. Returns the SHA-256 checksum
+    and size. The blob is written to a temporary file and moved in place, so
+    readers never see a partial file and identical blobs are stored once.
+
+    """
+    sha = hashlib.sha256()
+    size = 0
+    tmp = os.path.join(settings.PRODUCT_STORE, f'.{uuid.uuid4()}.tmp')
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                sha.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        checksum = sha.hexdigest()
+        path = store_path(checksum)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return checksum, size
+
+
+class FileBlob(object):
+    """File object reading a stored blob in chunks, with the size and
+    internal URL of the file.
+
+    """
+    def __init__(self, checksum, size, chunk_size=FILE_CHUNK_SIZE):
+        self.checksum = checksum
+        self.size = size
+        self.chunk_size = chunk_size
+        self.path = store_path(checksum)
+        self.url = store_url(checksum)
+        self.fh = None
+
+    def read(self, n=-1):
+        if self.fh is None:
+            self.fh = open(self.path, 'rb')
+        data = self.fh.read(n)
+        if not data or n < 0:
+            self.close()
+        return data
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
@@ -0,0 +1,28 @@
+from django.conf import settings
+
+from survey.models import Detection, ReleasedSource
+from survey.utils.components import get_survey_component_index
+from survey.utils.crossmatch import DetectionSet, SeparationCache
+from survey.utils.match import THRESH_SPAT, THRESH_SPEC
+from survey.utils.released import released_name_runs, check_released_sources
+
+
+def load_separation_cache(run, radius=2 * THRESH_SPAT, max_spec=2 * THRESH_SPEC):
+    """Build the separation cache of the accepted detections of a run against
+    the released sources of other runs within the outer radius (arcsec, Hz).
+
+    """
+    check_released_sources()
+    run_detections = Detection.objects.filter(run=run, accepted=True)
+    detections = DetectionSet.from_queryset(run_detections)
+    catalogue = DetectionSet.from_queryset(
+        ReleasedSource.objects.filter(
+            source_name__contains=settings.PROJECT
+        ).exclude(run=run).near(run_detections, radius),
+        fields=DetectionSet.RELEASED_FIELDS
+    )
+    run_components = get_survey_component_index(refresh=True).run_components
+    return SeparationCache.build(
+        detections, catalogue, run_components, released_name_runs(catalogue.source_names),
+        radius=radius, max_spec=max_spec, run_id=run.id
+    )
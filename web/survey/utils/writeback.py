@@ -0,0 +1,74 @@
+import logging
+
+from survey.models import Detection, TagDetection, ExternalConflict
+from survey.utils.released import update_released_sources
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class WriteBack(object):
+    """Collect curation decisions for detections and apply them to the
+    database in a handful of set-based statements.
+
+    Only the changed columns are written. Tag and external conflict rows that
+    already exist are not duplicated.
+
+    """
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.source_names = {}
+        self.accepted = {}
+        self.tags = {}
+        self.conflicts = {}
+
+    def set_source_name(self, detection_id, source_name):
+        self.source_names[int(detection_id)] = source_name
+
+    def set_accepted(self, detection_id, accepted):
+        self.accepted[int(detection_id)] = accepted
+
+    def add_tag(self, tag, detection_id, author):
+        self.tags.setdefault((tag.id, author), set()).add(int(detection_id))
+
+    def add_conflict(self, run_id, detection_id, conflict_detection_id):
+        self.conflicts.setdefault(int(run_id), set()).add((int(detection_id), int(conflict_detection_id)))
+
+    def apply(self):
+        """Write all collected decisions. Should be called inside a transaction.
+
+        """
+        if self.source_names:
+            Detection.objects.bulk_update(
+                [Detection(id=i, source_name=name) for i, name in self.source_names.items()],
+                ['source_name'],
+                batch_size=self.batch_size
+            )
+            logging.info(f'Updated source name of {len(self.source_names)} detections')
+
+        for value in (True, False):
+            ids = [i for i, accepted in self.accepted.items() if accepted is value]
+            if ids:
+                Detection.objects.filter(id__in=ids).update(accepted=value)
+                logging.info(f'Set accepted={value} for {len(ids)} detections')
+
+        for (tag_id, author), ids in self.tags.items():
+            existing = set(TagDetection.objects.filter(
+                tag_id=tag_id, detection_id__in=ids
+            ).values_list('detection_id', flat=True))
+            new = [TagDetection(tag_id=tag_id, detection_id=i, author=author) for i in sorted(ids - existing)]
+            TagDetection.objects.bulk_create(new, batch_size=self.batch_size, ignore_conflicts=True)
+            logging.info(f'Created {len(new)} tag detection entries for tag {tag_id} ({len(existing)} already exist)')
+
+        for run_id, pairs in self.conflicts.items():
+            existing = set(ExternalConflict.objects.filter(
+                run_id=run_id
+            ).values_list('detection_id', 'conflict_detection_id'))
+            new = [
+                ExternalConflict(run_id=run_id, detection_id=d, conflict_detection_id=c)
+                for d, c in sorted(pairs - existing)
+            ]
+            ExternalConflict.objects.bulk_create(new, batch_size=self.batch_size, ignore_conflicts=True)
+            logging.info(f'Created {len(new)} external conflicts for run {run_id}')
+
+        update_released_sources(set(self.source_names) | set(self.accepted))
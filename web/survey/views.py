@@ -1,31 +1,97 @@
-import io
 import os
-import tarfile
+import hashlib
 import urllib.parse
 import logging
 
-from urllib.request import pathname2url
-from survey.utils.io import tarfile_write
+from survey.utils.io import tarfile_stream
+from survey.utils.store import FileBlob
+from survey.utils.ranges import file_response
+from survey.utils.archive_cache import ArchiveCache, cache_enabled, archive_key, archive_marker
+from survey.utils.products import product_entries, iter_products, product_blob, product_filename
 from survey.utils.plot import product_summary_image
 from survey.utils.components import get_survey_component, get_release_name
 from survey.utils.forms import _add_tag, _add_comment
 from survey.utils.views import handle_navigation, handle_next
+from survey.utils.released import update_released_sources, release_name_collisions
+from survey.utils.locks import lock_release_names
+from survey.decorators import cacheable
+from survey.utils.match import THRESH_SPAT, THRESH_SPEC
 from survey.models import Product, Instance, Detection, Run, Tag, TagDetection, \
-    Comment, ExternalConflict, Task, FileTaskReturn
+    Comment, ExternalConflict, Task, FileTaskReturn, ReleasedSource
 from django.urls import reverse
-from django.db import transaction
+from django.db import connection, transaction
 from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth import logout
 from django.contrib import messages
 from django.conf import settings
 from django.utils.safestring import mark_safe
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition
 
 
 logging.basicConfig(level=logging.INFO)
 PRODUCTS = ['mom0', 'mom1', 'mom2',
             'cube', 'mask', 'chan', 'spec']
 
+# Seconds shared caches and clients may reuse responses without revalidating,
+# products do not change after ingest while catalogues change with curation
+PRODUCT_MAX_AGE = 7 * 24 * 3600
+CATALOG_MAX_AGE = 300
+
+
+def _etag(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+
+
+def _int_param(request, name):
+    try:
+        return int(request.GET.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def _detection_products_etag(request):
+    """ETag of the products of a detection, from the product row and the
+    names used in the file names.
+
+    """
+    row = Product.objects.filter(detection=_int_param(request, 'id')).values_list(
+        'id', 'detection__name', 'detection__run__name', 'detection__instance_id'
+    ).first()
+    if row is None:
+        return None
+    return _etag('detection_products', request.GET.get('product', '').lower(), *row)
+
+
+def _summary_image_etag(request):
+    product_id = Product.objects.filter(detection=_int_param(request, 'id')).values_list('id', flat=True).first()
+    if product_id is None:
+        return None
+    return _etag('summary_image', product_id)
+
+
+def _run_catalog_etag(request):
+    """ETag of a run catalogue, from a checksum of the detection rows of the
+    run computed by the database and the latest instance.
+
+    """
+    run_id = _int_param(request, 'id')
+    if run_id is None:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT md5(string_agg(d::text, ',' ORDER BY d.id)), "
+            "(SELECT name FROM run WHERE id = %s), "
+            "(SELECT concat(run_date, version) FROM instance WHERE run_id = %s ORDER BY run_date DESC LIMIT 1) "
+            "FROM detection d WHERE d.run_id = %s",
+            [run_id, run_id, run_id]
+        )
+        row = cursor.fetchone()
+    if row[0] is None:
+        return None
+    return _etag('run_catalog', run_id, *row)
+
 
 def logout_view(request):
     logout(request)
@@ -37,6 +103,8 @@ def test(request):
     return HttpResponse('Authorized', status=200)
 
 
+@cacheable(PRODUCT_MAX_AGE)
+@condition(etag_func=_summary_image_etag)
 def summary_image(request):
     detection_id = request.GET.get('id', None)
     if detection_id is None:
@@ -69,45 +137,38 @@ def instance_products(request):
     if not instance:
         return HttpResponse('no detections for this instance.', status=404)
 
-    fh = io.BytesIO()
-    with tarfile.open(fileobj=fh, mode='w:gz') as tar:
-        for d in detections:
-            name = f"{d.run.name}_{d.instance.id}_{d.name}"
-            name = pathname2url(name.replace(' ', '_'))
-            product = Product.objects.filter(detection=d).first()
-            if product is None:
-                return HttpResponse(
-                    f'no products for detection {d.id}.',
-                    status=404
-                )
-            folder = f'{d.name}'.replace(' ', '_')
-            tarfile_write(tar, f'{folder}/{name}_mom0.fits', product.mom0)
-            tarfile_write(tar, f'{folder}/{name}_mom1.fits', product.mom1)
-            tarfile_write(tar, f'{folder}/{name}_mom2.fits', product.mom2)
-            tarfile_write(tar, f'{folder}/{name}_cube.fits', product.cube)
-            tarfile_write(tar, f'{folder}/{name}_mask.fits', product.mask)
-            tarfile_write(tar, f'{folder}/{name}_chan.fits', product.chan)
-            tarfile_write(tar, f'{folder}/{name}_spec.txt', product.spec)
-
-    data = fh.getvalue()
-    size = len(data)
-    response = HttpResponse(data, content_type='application/x-tar')
-    response['Content-Disposition'] = f'attachment; \
+    # Checked up front, the response can not be changed once streaming
+    missing = detections.filter(product__isnull=True).values_list('id', flat=True).first()
+    if missing is not None:
+        return HttpResponse(f'no products for detection {missing}.', status=404)
+
+    return _archive_response(
+        request, 'instance_products', [instance.id], detections, PRODUCTS,
+        lambda: tarfile_stream(product_entries(detections)),
+        f'attachment; \
         filename={instance.run.name}_{instance.filename}.tar'
-    response['Content-Length'] = size
-    return response
+    )
 
 
-def _read_in_chunks(filename, chunk_size=1024*64):
-    with open(filename, 'rb') as infile:
-        while True:
-            chunk = infile.read(chunk_size)
-            if chunk:
-                yield chunk
-            else:
-                # The chunk was empty, which means we're at the end
-                # of the file
-                return
+def _archive_response(request, endpoint, ids, detections, products, build, disposition, etag=None):
+    """Response streaming the archive of products of detections generated by
+    ``build``. With the archive cache enabled, cached archives are sent from
+    the cache and new ones are written to it as they are streamed. Cached
+    archives are sent with ``etag``, the ETag the view sends for the archive,
+    or the cache key if the view has none.
+
+    """
+    chunks = None
+    if cache_enabled():
+        key = archive_key(endpoint, ids, products, archive_marker(detections))
+        path, chunks = ArchiveCache().get(key, build)
+        if path is not None:
+            # Archives are touched when used, the key identifies the content
+            return file_response(request, path, 'application/x-tar', disposition, etag=etag or quote_etag(key))
+
+    response = StreamingHttpResponse(streaming_content=chunks or build(), content_type='application/x-tar')
+    response['Content-Disposition'] = disposition
+    return response
 
 
 def task_file_download(request):
@@ -116,7 +177,10 @@ def task_file_download(request):
         return HttpResponse('task id does not exist.', status=400)
 
     task = Task.objects.filter(id=task_id).first()
-    if task.func not in ['download_accepted_sources', 'download_summaries']:
+    file_tasks = [
+        'download_accepted_sources', 'download_summaries', 'external_cross_match_preview', 'cross_match_sweep'
+    ]
+    if task.func not in file_tasks:
         return HttpResponse('No data.', status=404)
 
     if task.state != 'COMPLETED':
@@ -130,12 +194,11 @@ def task_file_download(request):
         return HttpResponse('Not a File Task', status=400)
 
     filename = task.get_paths()[0]
-    response = StreamingHttpResponse(streaming_content=_read_in_chunks(filename))
-    response['Content-Disposition'] = f'attachment; filename={os.path.basename(filename)}'
-    response['Content-Length'] = os.path.getsize(filename)
-    return response
+    return file_response(request, filename, disposition=f'attachment; filename={os.path.basename(filename)}')
 
 
+@cacheable(PRODUCT_MAX_AGE)
+@condition(etag_func=_detection_products_etag)
 def detection_products(request):
     detect_id = request.GET.get('id', None)
     if not detect_id:
@@ -152,74 +215,28 @@ def detection_products(request):
         if product_arg not in PRODUCTS:
             return HttpResponse('not a valid detection product.', status=400)
 
+    products = PRODUCTS + ['plot'] if product_arg is None else [product_arg]
+    product = next(iter_products([detect_id], blobs=products), None)
+    if not product:
+        return HttpResponse('Products not found.', status=404)
+
+    name = product_filename(product.detection)
+
     if product_arg is None:
-        product = Product.objects.filter(detection=detect_id)\
-            .select_related(
-                'detection',
-                'detection__instance',
-                'detection__run')\
-            .only(
-                'detection__name',
-                'detection__instance__id',
-                'detection__run__name',
-                'mom0',
-                'mom1',
-                'mom2',
-                'cube',
-                'mask',
-                'chan',
-                'spec',
-                'plot')\
-            .first()
-
-        if not product:
-            return HttpResponse('Products not found.', status=404)
-
-        detection = product.detection
-        name = f"{detection.run.name}_{detection.instance.id}_{detection.name}"
-        name = pathname2url(name.replace(' ', '_'))
-
-        fh = io.BytesIO()
-        with tarfile.open(fileobj=fh, mode='w:gz') as tar:
-            tarfile_write(tar, f'{name}_mom0.fits', product.mom0)
-            tarfile_write(tar, f'{name}_mom1.fits', product.mom1)
-            tarfile_write(tar, f'{name}_mom2.fits', product.mom2)
-            tarfile_write(tar, f'{name}_cube.fits', product.cube)
-            tarfile_write(tar, f'{name}_mask.fits', product.mask)
-            tarfile_write(tar, f'{name}_chan.fits', product.chan)
-            tarfile_write(tar, f'{name}_spec.txt', product.spec)
-            tarfile_write(tar, f'{name}_plot.png', product.plot)
-
-        data = fh.getvalue()
-        size = len(data)
-
-        response = HttpResponse(data, content_type='application/x-tar')
-        response['Content-Disposition'] = f'attachment; filename={name}.tar.gz'
-        response['Content-Length'] = size
-        return response
+        return _archive_response(
+            request, 'detection_products', [detect_id], [detect_id], products,
+            lambda: tarfile_stream(
+                (f"{name}_{p}.{'txt' if p == 'spec' else 'png' if p == 'plot' else 'fits'}", product_blob(product, p))
+                for p in products
+            ),
+            f'attachment; filename={name}.tar.gz',
+            etag=quote_etag(_detection_products_etag(request))
+        )
 
     else:
-        product = Product.objects.filter(detection=detect_id)\
-            .select_related(
-                'detection',
-                'detection__instance',
-                'detection__run')\
-            .only(
-                'detection__name',
-                'detection__instance__id',
-                'detection__run__name',
-                product_arg)
-        if not product:
-            return HttpResponse('products not found.', status=404)
-
-        detect_name = product[0].detection.name
-        run_name = product[0].detection.run.name
-        inst_name = product[0].detection.instance.id
-        name = f"{run_name}_{inst_name}_{detect_name}"
-        name = pathname2url(name.replace(' ', '_'))
-
-        data = getattr(product[0], product_arg)
-        size = len(data)
+        data = product_blob(product, product_arg)
+        if data is None:
+            return HttpResponse('product not found.', status=404)
 
         content_type = 'image/fits'
         ext = "fits"
@@ -227,10 +244,18 @@ def detection_products(request):
             content_type = "text/plain"
             ext = "txt"
 
-        response = HttpResponse(data, content_type=content_type)
+        if isinstance(data, bytes):
+            response = HttpResponse(data, content_type=content_type)
+            response['Content-Length'] = len(data)
+        elif isinstance(data, FileBlob):
+            # nginx sends the file from the product store
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = data.url
+        else:
+            response = StreamingHttpResponse(streaming_content=data, content_type=content_type)
+            response['Content-Length'] = data.size
         response['Content-Disposition'] = f'attachment; \
             filename={name}_{product_arg}.{ext}'
-        response['Content-Length'] = size
         return response
 
 
@@ -256,34 +281,16 @@ def run_products(request):
     if detections is None:
         return HttpResponse('no detections for this run.', status=404)
 
-    fh = io.BytesIO()
-    with tarfile.open(fileobj=fh, mode='w:gz') as tar:
-        for d in detections:
-            name = f"{d.run.name}_{d.instance.id}_{d.name}"
-            name = pathname2url(name.replace(' ', '_'))
-            product = Product.objects.filter(detection=d).first()
-            if product is None:
-                return HttpResponse(
-                    f'no products for detection {d.id}.',
-                    status=404
-                )
-            folder = f'{d.name}'.replace(' ', '_')
-            tarfile_write(tar, f'{folder}/{name}_mom0.fits', product.mom0)
-            tarfile_write(tar, f'{folder}/{name}_mom1.fits', product.mom1)
-            tarfile_write(tar, f'{folder}/{name}_mom2.fits', product.mom2)
-            tarfile_write(tar, f'{folder}/{name}_cube.fits', product.cube)
-            tarfile_write(tar, f'{folder}/{name}_mask.fits', product.mask)
-            tarfile_write(tar, f'{folder}/{name}_chan.fits', product.chan)
-            tarfile_write(tar, f'{folder}/{name}_spec.txt', product.spec)
-
-    data = fh.getvalue()
-    size = len(data)
-
-    response = HttpResponse(data, content_type='application/x-tar')
-    response['Content-Disposition'] = f'attachment; \
+    missing = detections.filter(product__isnull=True).values_list('id', flat=True).first()
+    if missing is not None:
+        return HttpResponse(f'no products for detection {missing}.', status=404)
+
+    return _archive_response(
+        request, 'run_products', [run.id], detections, PRODUCTS,
+        lambda: tarfile_stream(product_entries(detections)),
+        f'attachment; \
         filename={run.id}_{run.name}_products.tar'
-    response['Content-Length'] = size
-    return response
+    )
 
 
 def _build_detection(detection):
@@ -394,6 +401,8 @@ def _build_catalog(detections, date, version):
     return cat
 
 
+@cacheable(CATALOG_MAX_AGE)
+@condition(etag_func=_run_catalog_etag)
 def run_catalog(request):
     run_id = request.GET.get('id', None)
     if not run_id:
@@ -592,6 +601,13 @@ def external_conflict_view(request):
         conflict_survey_component = get_survey_component(ex_c.conflict_detection)
         same_survey_component = detection_survey_component == conflict_survey_component
 
+        # Other released sources within the cross matching thresholds of the detection
+        nearby_sources = ReleasedSource.objects.cone_freq(
+            ex_c.detection.ra, ex_c.detection.dec, THRESH_SPAT, ex_c.detection.freq, THRESH_SPEC
+        ).exclude(
+            detection_id__in=[ex_c.detection_id, ex_c.conflict_detection_id]
+        ).order_by('source_name').values_list('source_name', 'run__name')
+
         # Form content
         params = {
             'title': ex_c.detection.name,
@@ -608,6 +624,7 @@ def external_conflict_view(request):
             'external_conflict_id': ex_c.id,
             'tags': Tag.objects.all(),
             'same_survey_component': same_survey_component,
+            'nearby_sources': [f'{name} [{run_name}]' for name, run_name in nearby_sources],
         }
         logging.info(f'External conflict {ex_c.detection} [{detection_survey_component}] with {ex_c.conflict_detection} [{conflict_survey_component}]')
         return render(request, 'admin/form_external_conflict.html', params)
@@ -636,20 +653,25 @@ def external_conflict_view(request):
         if 'Keep new source name' in body['action']:
             with transaction.atomic():
                 # Check against existing sources
+                lock_release_names()
                 new_name = get_release_name(ex_c.detection.name)
-                if new_name in [d.source_name for d in Detection.objects.filter(accepted=True, source_name__isnull=False).exclude(id=ex_c.detection.id)]:
-                    messages.error(request, f"Existing source with name {new_name} exists so cannot accept this detection.")
+                collisions = release_name_collisions([new_name], exclude_ids=[ex_c.detection.id])
+                if collisions:
+                    held = ', '.join(f'{d_id} [{run_name}]' for d_id, run_name in collisions[new_name])
+                    messages.error(
+                        request,
+                        f"Existing source with name {new_name} exists (detection {held}) so cannot accept this detection."
+                    )
                     url = f"{reverse('external_conflict')}?run_id={run.id}&external_conflict_id={conflicts[idx].id}"
                     return HttpResponseRedirect(url)
                 # Accept new name as an official (and separate) source
                 logging.info(f'Adding official name {new_name} to detection {ex_c.detection.name}')
                 ex_c.detection.source_name = new_name
                 ex_c.detection.save()
+                update_released_sources([ex_c.detection.id])
                 # Remove external conflicts that reference this detection
-                for c in conflicts:
-                    if c.detection == ex_c.detection:
-                        logging.info(f'Removing external conflict for this detection: {c.id}')
-                        c.delete()
+                removed, _ = conflicts.filter(detection_id=ex_c.detection_id).delete()
+                logging.info(f'Removed {removed} external conflicts for this detection')
                 conflicts = ExternalConflict.objects.filter(
                     detection_id__in=[d.id for d in Detection.objects.filter(run=run)]
                 )
@@ -661,6 +683,7 @@ def external_conflict_view(request):
                 logging.info(f'Adding existing source name {ex_c.conflict_detection.source_name} to current detection {ex_c.detection.name}.')
                 ex_c.detection.source_name = ex_c.conflict_detection.source_name
                 ex_c.detection.save()
+                update_released_sources([ex_c.detection.id])
                 ex_c.delete()
             url = handle_next(request, conflicts, idx, reverse('external_conflict'), f'run_id={run.id}&external_conflict_id=')
             return HttpResponseRedirect(url)
@@ -673,6 +696,7 @@ def external_conflict_view(request):
                 ex_c.detection.save()
                 ex_c.conflict_detection.source_name = None
                 ex_c.conflict_detection.save()
+                update_released_sources([ex_c.detection.id, ex_c.conflict_detection.id])
 
                 # Remove release tag detection entry for replaced detection
                 remove_tagdetections = TagDetection.objects.filter(detection=ex_c.conflict_detection, tag__type='release')
@@ -681,10 +705,8 @@ def external_conflict_view(request):
                     td.delete()
 
                 # Remove external conflicts that reference this detection
-                for c in conflicts:
-                    if c.detection == ex_c.detection:
-                        logging.info(f'Removing external conflict for this detection: {c.id}')
-                        c.delete()
+                removed, _ = conflicts.filter(detection_id=ex_c.detection_id).delete()
+                logging.info(f'Removed {removed} external conflicts for this detection')
                 conflicts = ExternalConflict.objects.filter(
                     detection_id__in=[d.id for d in Detection.objects.filter(run=run)]
                 )
@@ -698,6 +720,7 @@ def external_conflict_view(request):
                 ex_c.detection.source_name = None
                 ex_c.detection.accepted = False
                 ex_c.detection.save()
+                update_released_sources([ex_c.detection.id])
 
                 # Remove external conflicts
                 logging.info(f'Deleting external conflicts for detection {ex_c.detection}')